@@ -5,7 +5,15 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import argparse
+import base64
+import concurrent.futures
+import contextlib
+import copy
 import datetime
+import fnmatch
+import functools
+import gzip
+import hashlib
 import io
 import json
 import mimetypes
@@ -13,9 +21,190 @@ import os
 import secrets
 import subprocess
 import sys
+import threading
+import time
+import urllib.request
 import zipfile
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_UPLOAD_WORKERS = 16
+DEFAULT_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+DEFAULT_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+# Minimum number of seconds between two progress reports of a transfer
+PROGRESS_INTERVAL = 5
+# Largest object that can be copied with a single copy_object call
+COPY_OBJECT_LIMIT = 5 * 1024 * 1024 * 1024
+# Cache-Control of the wiki files, the first matching pattern applies. Astro
+# fingerprints the file names of its assets, so they never change.
+CACHE_CONTROL_POLICIES = [
+    ("_astro/*", "public, max-age=31536000, immutable"),
+    ("*.html", "public, max-age=300"),
+]
+DEFAULT_CACHE_CONTROL = "public, max-age=3600"
+COMPRESSIBLE_CONTENT_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/manifest+json",
+    "application/xml",
+    "image/svg+xml",
+    "text/javascript",
+}
+DEFAULT_PRECOMPRESS = "gzip"
+# Timestamp of the files in a Lambda@Edge deployment package
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# Files and directories of the wiki that its build depends on
+WIKI_BUILD_INPUTS = [
+    "astro.config.mjs",
+    "package-lock.json",
+    "package.json",
+    "public",
+    "src",
+    "tsconfig.json",
+]
+# Largest number of keys that can be deleted with a single delete_objects call
+DELETE_OBJECTS_LIMIT = 1000
+# Number of wiki versions kept next to the current one
+DEFAULT_KEEP_VERSIONS = 5
+# Invalidation paths are collapsed into wildcards beyond this number of paths
+DEFAULT_MAX_INVALIDATION_PATHS = 15
+
+
+class Tracer:
+    # Spans of the deploy stages and AWS calls, exported as Chrome trace events that
+    # can be opened in chrome://tracing or https://ui.perfetto.dev
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.events = []
+        self.thread_names = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get_stack(self, name):
+        # Open spans or AWS calls of the current thread, innermost last
+        if not hasattr(self.local, name):
+            setattr(self.local, name, [])
+        return getattr(self.local, name)
+
+    def add_event(self, name, category, started, args):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((started - self.started) * 1e6),
+            "dur": round((time.perf_counter() - started) * 1e6),
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": args,
+        }
+        with self.lock:
+            self.thread_names.setdefault(thread.ident, thread.name)
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, category="stage", **args):
+        spans = self.get_stack("spans")
+        spans.append((category, args))
+        started = time.perf_counter()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = repr(e)
+            raise
+        finally:
+            spans.pop()
+            self.add_event(name, category, started, args)
+
+    def annotate(self, **args):
+        # Adds to the arguments of the innermost span of the current thread
+        spans = self.get_stack("spans")
+        if spans:
+            spans[-1][1].update(args)
+
+    def instrument(self, session):
+        # Records every call of the clients created from the boto3 session from now on
+        session.events.register("before-call", self.before_aws_call)
+        session.events.register("before-send", self.before_aws_send)
+        session.events.register("after-call", self.after_aws_call)
+        session.events.register("after-call-error", self.after_aws_call_error)
+
+    def before_aws_call(self, model, **kwargs):
+        self.get_stack("calls").append(
+            {
+                "started": time.perf_counter(),
+                "name": f"{model.service_model.service_name}.{model.name}",
+                "attempts": 0,
+                "bytes_sent": 0,
+            }
+        )
+
+    def before_aws_send(self, request, **kwargs):
+        # Sent once for every attempt of the call, streamed uploads are aws-chunked
+        # with the size of the payload in a separate header
+        calls = self.get_stack("calls")
+        if calls:
+            size = request.headers.get("X-Amz-Decoded-Content-Length")
+            if size is None:
+                size = request.headers.get("Content-Length")
+            calls[-1]["attempts"] += 1
+            calls[-1]["bytes_sent"] += int(size or 0)
+
+    def after_aws_call(self, http_response, **kwargs):
+        self.finish_aws_call(
+            status=http_response.status_code,
+            bytes_received=int(http_response.headers.get("Content-Length") or 0),
+        )
+
+    def after_aws_call_error(self, exception, **kwargs):
+        self.finish_aws_call(error=repr(exception))
+
+    def finish_aws_call(self, **args):
+        calls = self.get_stack("calls")
+        if not calls:
+            return
+        call = calls.pop()
+        started = call.pop("started")
+        name = call.pop("name")
+        self.add_event(name, "aws", started, {**call, **args})
+
+        # Waiters poll with the calls made within their span
+        spans = self.get_stack("spans")
+        if spans:
+            category, span_args = spans[-1]
+            key = "polls" if category == "waiter" else "aws_calls"
+            span_args[key] = span_args.get(key, 0) + 1
+
+    def write(self, path):
+        with self.lock:
+            events = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+                for tid, name in self.thread_names.items()
+            ] + self.events
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        print(f"Trace with {len(events)} events written to {path}")
+
+
+tracer = Tracer()
+
+
+def traced(name, category="stage"):
+    # Records every call of the decorated function as a span
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name, category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
 
 
 def remove_version_from_function_arn(function_arn):
@@ -34,6 +223,137 @@ def get_cloudfront_config(session, cloudfront_distribution_id):
     return distribution_config, etag
 
 
+def get_associated_function_arns(distribution_config):
+    # Versioned ARNs of the lambda functions associated with the distribution, by function name
+    cache_behaviors = distribution_config.get("CacheBehaviors", {}).get("Items", [])
+    default_cache_behavior = distribution_config["DefaultCacheBehavior"]
+    function_arns = {}
+    for cache_behavior in cache_behaviors + [default_cache_behavior]:
+        associations = cache_behavior.get("LambdaFunctionAssociations", {})
+        for association in associations.get("Items", []):
+            function_arn = association["LambdaFunctionARN"]
+            unversioned_arn = remove_version_from_function_arn(function_arn)
+            function_arns[unversioned_arn.split(":")[-1]] = function_arn
+    return function_arns
+
+
+@traced("package lambda")
+def get_deployment_package(bundle_path, config):
+    # Fixed timestamps and permissions, so the same bundle and config always give the
+    # same package, with the same CodeSha256
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, "w") as zip_file:
+        with open(bundle_path, "rb") as f:
+            bundle = f.read()
+        for name, data in [
+            ("bundle.js", bundle),
+            ("config.json", json.dumps(config).encode("utf-8")),
+        ]:
+            zip_info = zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME)
+            zip_info.external_attr = 0o644 << 16
+            zip_file.writestr(zip_info, data)
+    tracer.annotate(bundle=bundle_path, bytes=zip_buffer.getbuffer().nbytes)
+    return zip_buffer.getvalue()
+
+
+def get_code_sha256(package):
+    return base64.b64encode(hashlib.sha256(package).digest()).decode("ascii")
+
+
+@traced("download deployed lambda")
+def get_deployed_config(code_location):
+    # The config.json of a deployed package, from the presigned URL returned by get_function.
+    # The placeholder version created by the infrastructure has no config.json.
+    with urllib.request.urlopen(code_location, timeout=60) as response:
+        package = response.read()
+    tracer.annotate(bytes=len(package))
+    with zipfile.ZipFile(io.BytesIO(package)) as zip_file:
+        if "config.json" not in zip_file.namelist():
+            return {}
+        return json.loads(zip_file.read("config.json"))
+
+
+def get_nonce_signing_secret(deployed_config):
+    csrf_protection = deployed_config.get("csrfProtection")
+    if not isinstance(csrf_protection, dict):
+        return None
+    return csrf_protection.get("nonceSigningSecret") or None
+
+
+def plan_edge_lambdas(
+    lambda_client,
+    cognito_region,
+    user_pool_id,
+    user_pool_app_id,
+    user_pool_app_secret,
+    user_pool_domain,
+    distribution_config,
+    function_prefix="wiki-",
+    function_postfix="",
+    lambda_edge_artifact_dir="",
+    rotate_nonce_secret=False,
+):
+    # The deployment package of each lambda function, with the version associated with
+    # the distribution if that version has the same package
+    associated_function_arns = get_associated_function_arns(distribution_config)
+    new_nonce_signing_secret = secrets.token_urlsafe(64)
+    packages = []
+    for root, dirs, files in os.walk(lambda_edge_artifact_dir):
+        if "bundle.js" not in files:
+            continue
+
+        relpath = os.path.relpath(root, lambda_edge_artifact_dir)
+        bundle_relpath = os.path.join(relpath, "bundle.js")
+        function_name = f"{function_prefix}{relpath.split('/')[-1]}{function_postfix}"
+        print("Creating deployment package for: ", bundle_relpath)
+
+        # The version currently associated with the distribution, if any
+        associated_function = None
+        associated_arn = associated_function_arns.get(function_name)
+        if associated_arn:
+            associated_function = lambda_client.get_function(
+                FunctionName=associated_arn
+            )
+
+        # Keep the nonce signing secret of the associated version, so the nonces of
+        # signed in users stay valid and an unchanged bundle keeps the same package
+        deployed_secret = None
+        if associated_function and not rotate_nonce_secret:
+            deployed_config = get_deployed_config(
+                associated_function["Code"]["Location"]
+            )
+            deployed_secret = get_nonce_signing_secret(deployed_config)
+        # Without a deployed secret, e.g. for the placeholder version created by the
+        # infrastructure, a new secret is used and the version is published again
+        nonce_signing_secret = deployed_secret or new_nonce_signing_secret
+
+        package = get_deployment_package(
+            os.path.join(root, "bundle.js"),
+            {
+                "region": cognito_region,
+                "userPoolId": user_pool_id,
+                "userPoolAppId": user_pool_app_id,
+                "userPoolAppSecret": user_pool_app_secret,
+                "userPoolDomain": user_pool_domain,
+                "httpOnly": True,
+                "sameSite": "Lax",
+                "csrfProtection": {
+                    "nonceSigningSecret": nonce_signing_secret,
+                },
+                "logLevel": "debug",
+            },
+        )
+
+        unchanged_arn = None
+        if deployed_secret and associated_function["Configuration"][
+            "CodeSha256"
+        ] == get_code_sha256(package):
+            unchanged_arn = associated_arn
+        packages.append((function_name, package, unchanged_arn))
+    return packages
+
+
+@traced("deploy lambda@edge")
 def deploy_edge_lambdas(
     session_us_east_1,
     cognito_region,
@@ -45,57 +365,45 @@ def deploy_edge_lambdas(
     function_prefix="wiki-",
     function_postfix="",
     lambda_edge_artifact_dir="",
+    rotate_nonce_secret=False,
 ):
     # Lambda@Edge always lives in us-east-1
     lambda_client = session_us_east_1.client("lambda")
 
     if not lambda_edge_artifact_dir:
         # Build the lambda-edge project
-        subprocess.run(
-            ["npm", "run", "build"],
-            cwd=os.path.join(CURRENT_DIR, "lambda-edge"),
-            check=True,
-            capture_output=True,
-        )
+        with tracer.span("build lambda@edge"):
+            subprocess.run(
+                ["npm", "run", "build"],
+                cwd=os.path.join(CURRENT_DIR, "lambda-edge"),
+                check=True,
+                capture_output=True,
+            )
         lambda_edge_artifact_dir = os.path.join(CURRENT_DIR, "lambda-edge", "src")
 
     # Deploy each lambda function (there is currently only one, but multiple is supported)
-    nonce_signing_secret = secrets.token_urlsafe(64)
-    for root, dirs, files in os.walk(lambda_edge_artifact_dir):
-        if "bundle.js" not in files:
+    packages = plan_edge_lambdas(
+        lambda_client,
+        cognito_region=cognito_region,
+        user_pool_id=user_pool_id,
+        user_pool_app_id=user_pool_app_id,
+        user_pool_app_secret=user_pool_app_secret,
+        user_pool_domain=user_pool_domain,
+        distribution_config=distribution_config,
+        function_prefix=function_prefix,
+        function_postfix=function_postfix,
+        lambda_edge_artifact_dir=lambda_edge_artifact_dir,
+        rotate_nonce_secret=rotate_nonce_secret,
+    )
+    for function_name, package, unchanged_arn in packages:
+        if unchanged_arn:
+            print("Lambda is unchanged, keeping version:", unchanged_arn)
             continue
 
-        relpath = os.path.relpath(root, lambda_edge_artifact_dir)
-        bundle_relpath = os.path.join(relpath, "bundle.js")
-        print("Creating deployment package for: ", bundle_relpath)
-
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w") as zip_file:
-            zip_file.write(os.path.join(root, "bundle.js"), "bundle.js")
-            zip_file.writestr(
-                "config.json",
-                json.dumps(
-                    {
-                        "region": cognito_region,
-                        "userPoolId": user_pool_id,
-                        "userPoolAppId": user_pool_app_id,
-                        "userPoolAppSecret": user_pool_app_secret,
-                        "userPoolDomain": user_pool_domain,
-                        "httpOnly": True,
-                        "sameSite": "Lax",
-                        "csrfProtection": {
-                            "nonceSigningSecret": nonce_signing_secret,
-                        },
-                        "logLevel": "debug",
-                    }
-                ),
-            )
-        zip_buffer.seek(0)
-
         print("Deploying to lambda...")
         result = lambda_client.update_function_code(
-            FunctionName=f"{function_prefix}{relpath.split('/')[-1]}{function_postfix}",
-            ZipFile=zip_buffer.read(),
+            FunctionName=function_name,
+            ZipFile=package,
             Publish=True,
         )
         new_version = result["Version"]
@@ -104,7 +412,8 @@ def deploy_edge_lambdas(
 
         print("Waiting until lambda is active...")
         waiter = lambda_client.get_waiter("function_active_v2")
-        waiter.wait(FunctionName=arn)
+        with tracer.span("wait function_active_v2", "waiter", function=arn):
+            waiter.wait(FunctionName=arn)
         print("Function is now active")
 
         # Updating cloudfront distribution config with updated lambda arn
@@ -128,44 +437,422 @@ def get_current_wiki_version(distribution_config):
     return origin_path
 
 
+def get_s3_client(session, max_workers=DEFAULT_UPLOAD_WORKERS):
+    from botocore.config import Config
+
+    # One client is shared by all upload threads, with a connection for each of them
+    return session.client(
+        "s3",
+        config=Config(
+            max_pool_connections=max_workers,
+            retries={"mode": "standard", "max_attempts": 5},
+        ),
+    )
+
+
+def get_local_files(artifact_dir):
+    local_files = []
+    for root, dirs, files in os.walk(artifact_dir):
+        for filename in files:
+            local_path = os.path.join(root, filename)
+            relative_path = os.path.relpath(local_path, artifact_dir)
+            local_files.append((local_path, relative_path.replace(os.sep, "/")))
+    return local_files
+
+
+def format_size(size):
+    for unit in ["B", "KiB", "MiB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+class TransferProgress:
+    # total_bytes is None when the size is only known once a file is transferred
+    def __init__(self, action, total_files, total_bytes=None):
+        self.action = action
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.reported = self.started
+        self.lock = threading.Lock()
+
+    def update(self, size):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            now = time.monotonic()
+            if now - self.reported >= PROGRESS_INTERVAL:
+                self.reported = now
+                transferred = format_size(self.bytes)
+                if self.total_bytes is not None:
+                    transferred += f"/{format_size(self.total_bytes)}"
+                print(
+                    f"{self.action} {self.files}/{self.total_files} files "
+                    f"({transferred})"
+                )
+
+    def summary(self):
+        duration = time.monotonic() - self.started
+        throughput = self.bytes / duration if duration else 0
+        return (
+            f"{self.action} {self.files} files ({format_size(self.bytes)}) "
+            f"in {duration:.1f}s ({format_size(throughput)}/s)"
+        )
+
+
+def compress(data, encoding):
+    if encoding == "br":
+        import brotli
+
+        return brotli.compress(data, quality=11)
+    # Without a timestamp the output is the same for the same input
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def upload_file(s3, s3_bucket, local_path, s3_path, extra_args, transfer_config):
+    # Returns the number of bytes sent, after compression
+    with open(local_path, "rb") as f, tracer.span("upload", "s3", key=s3_path) as span:
+        body = f
+        size = os.path.getsize(local_path)
+        if "ContentEncoding" in extra_args:
+            body = io.BytesIO(compress(f.read(), extra_args["ContentEncoding"]))
+            size = body.getbuffer().nbytes
+        span["bytes"] = size
+        if size < transfer_config.multipart_threshold:
+            # Small files are uploaded in a single request from the calling thread
+            s3.put_object(Bucket=s3_bucket, Key=s3_path, Body=body, **extra_args)
+        else:
+            s3.upload_fileobj(
+                body, s3_bucket, s3_path, ExtraArgs=extra_args, Config=transfer_config
+            )
+    return size
+
+
+def copy_object(s3, s3_bucket, source_path, s3_path):
+    s3.copy_object(
+        Bucket=s3_bucket,
+        Key=s3_path,
+        CopySource={"Bucket": s3_bucket, "Key": source_path},
+        MetadataDirective="COPY",
+    )
+
+
+@traced("transfer files")
+def transfer_files(
+    s3,
+    s3_bucket,
+    uploads,
+    copies=(),
+    max_workers=DEFAULT_UPLOAD_WORKERS,
+    multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+    multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE,
+):
+    # Upload (local_path, s3_path, extra_args) files and server-side copy
+    # (source_path, s3_path, size) objects within the bucket
+    from boto3.s3.transfer import TransferConfig
+
+    transfer_config = TransferConfig(
+        multipart_threshold=multipart_threshold,
+        multipart_chunksize=multipart_chunksize,
+    )
+    # Files are compressed while they are uploaded, so the size sent is only known
+    # once the upload finishes
+    upload_progress = TransferProgress("Uploaded", len(uploads))
+    copy_progress = TransferProgress(
+        "Copied", len(copies), sum(size for _, _, size in copies)
+    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for local_path, s3_path, extra_args in uploads:
+            future = executor.submit(
+                upload_file,
+                s3,
+                s3_bucket,
+                local_path,
+                s3_path,
+                extra_args,
+                transfer_config,
+            )
+            futures[future] = (upload_progress, None)
+        for source_path, s3_path, size in copies:
+            future = executor.submit(copy_object, s3, s3_bucket, source_path, s3_path)
+            futures[future] = (copy_progress, size)
+        for future in concurrent.futures.as_completed(futures):
+            progress, size = futures[future]
+            uploaded_size = future.result()
+            progress.update(size if size is not None else uploaded_size)
+    tracer.annotate(
+        uploaded_files=upload_progress.files,
+        uploaded_bytes=upload_progress.bytes,
+        copied_files=copy_progress.files,
+        copied_bytes=copy_progress.bytes,
+    )
+    print(upload_progress.summary())
+    if copies:
+        print(copy_progress.summary())
+
+
+def get_file_hash(path):
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_manifest_key(version):
+    # Stored next to the version prefix, so it is not served through cloudfront
+    return f"{version}.manifest.json"
+
+
+def load_manifest(s3, s3_bucket, version):
+    if not version:
+        return None
+    try:
+        result = s3.get_object(Bucket=s3_bucket, Key=get_manifest_key(version))
+    except s3.exceptions.NoSuchKey:
+        print(f"No manifest found for wiki version {version}")
+        return None
+    return json.loads(result["Body"].read())
+
+
+def save_manifest(s3, s3_bucket, manifest):
+    s3.put_object(
+        Bucket=s3_bucket,
+        Key=get_manifest_key(manifest["version"]),
+        Body=json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+def get_cache_control(relative_path):
+    for pattern, cache_control in CACHE_CONTROL_POLICIES:
+        if fnmatch.fnmatch(relative_path, pattern):
+            return cache_control
+    return DEFAULT_CACHE_CONTROL
+
+
+def is_compressible(mimetype):
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_CONTENT_TYPES
+
+
+def get_upload_args(relative_path, precompress=DEFAULT_PRECOMPRESS):
+    mimetype = mimetypes.guess_type(relative_path)[0]
+    extra_args = {"CacheControl": get_cache_control(relative_path)}
+    if mimetype:
+        extra_args["ContentType"] = mimetype
+        if precompress and is_compressible(mimetype):
+            extra_args["ContentEncoding"] = precompress
+    return extra_args
+
+
+@traced("build manifest")
+def build_manifest(
+    version, artifact_dir, precompress=DEFAULT_PRECOMPRESS, fingerprint=None
+):
+    files = {}
+    for local_path, relative_path in get_local_files(artifact_dir):
+        files[relative_path] = {
+            "sha256": get_file_hash(local_path),
+            "size": os.path.getsize(local_path),
+            "extra_args": get_upload_args(relative_path, precompress),
+        }
+    tracer.annotate(
+        files=len(files), bytes=sum(entry["size"] for entry in files.values())
+    )
+    return {"version": version, "fingerprint": fingerprint, "files": files}
+
+
+@traced("fingerprint wiki")
+def get_wiki_fingerprint(wiki_dir, precompress=DEFAULT_PRECOMPRESS):
+    # Hash of the build inputs and the upload settings of the wiki, None if the wiki
+    # sources are not available
+    if not os.path.isdir(os.path.join(wiki_dir, "src")):
+        return None
+    fingerprint = hashlib.sha256()
+    fingerprint.update(
+        json.dumps(
+            [precompress, CACHE_CONTROL_POLICIES, DEFAULT_CACHE_CONTROL]
+        ).encode()
+    )
+    for build_input in WIKI_BUILD_INPUTS:
+        path = os.path.join(wiki_dir, build_input)
+        if os.path.isdir(path):
+            input_files = sorted(
+                (f"{build_input}/{relative_path}", local_path)
+                for local_path, relative_path in get_local_files(path)
+            )
+        elif os.path.isfile(path):
+            input_files = [(build_input, path)]
+        else:
+            input_files = []
+        for relative_path, local_path in input_files:
+            fingerprint.update(
+                f"{relative_path}\0{get_file_hash(local_path)}\n".encode()
+            )
+    return fingerprint.hexdigest()
+
+
+def is_wiki_unchanged(old_manifest, fingerprint):
+    return bool(
+        fingerprint and old_manifest and old_manifest.get("fingerprint") == fingerprint
+    )
+
+
+def is_file_unchanged(old_manifest, relative_path, entry):
+    if old_manifest is None:
+        return False
+    old_entry = old_manifest["files"].get(relative_path)
+    return (
+        old_entry is not None
+        and old_entry["sha256"] == entry["sha256"]
+        and old_entry["extra_args"] == entry["extra_args"]
+        and entry["size"] < COPY_OBJECT_LIMIT
+    )
+
+
+def plan_wiki_transfer(old_manifest, new_manifest, artifact_dir):
+    # Files that did not change since the previous version are copied server-side
+    uploads = []
+    copies = []
+    for relative_path, entry in new_manifest["files"].items():
+        s3_path = f"{new_manifest['version']}/{relative_path}"
+        if is_file_unchanged(old_manifest, relative_path, entry):
+            source_path = f"{old_manifest['version']}/{relative_path}"
+            copies.append((source_path, s3_path, entry["size"]))
+        else:
+            local_path = os.path.join(artifact_dir, *relative_path.split("/"))
+            uploads.append((local_path, s3_path, entry["extra_args"]))
+    return uploads, copies
+
+
+def get_changed_files(old_manifest, new_manifest):
+    # Returns None if the changes are unknown because there is no previous manifest
+    if old_manifest is None:
+        return None
+    changed_files = [
+        relative_path
+        for relative_path, entry in new_manifest["files"].items()
+        if old_manifest["files"].get(relative_path, {}).get("sha256") != entry["sha256"]
+        or old_manifest["files"][relative_path]["extra_args"] != entry["extra_args"]
+    ]
+    removed_files = [
+        relative_path
+        for relative_path in old_manifest["files"]
+        if relative_path not in new_manifest["files"]
+    ]
+    return sorted(changed_files + removed_files)
+
+
+def get_url_paths(relative_path):
+    # Astro pages are served from their directory URL as well
+    paths = [f"/{relative_path}"]
+    if relative_path == "index.html":
+        paths.append("/")
+    elif relative_path.endswith("/index.html"):
+        directory = relative_path[: -len("/index.html")]
+        paths += [f"/{directory}/", f"/{directory}"]
+    return paths
+
+
+def collapse_invalidation_paths(paths, max_paths=DEFAULT_MAX_INVALIDATION_PATHS):
+    # Replace the paths sharing the directory prefix that covers most of them with a
+    # wildcard, until the number of paths is within the maximum
+    paths = set(paths)
+    while len(paths) > max_paths:
+        prefixes = {}
+        for path in paths:
+            parts = path.rstrip("*").strip("/").split("/")
+            for depth in range(1, len(parts)):
+                prefix = "/" + "/".join(parts[:depth])
+                prefixes[prefix] = prefixes.get(prefix, 0) + 1
+        candidates = [(count, len(p), p) for p, count in prefixes.items() if count > 1]
+        if not candidates:
+            return ["/*"]
+        _, _, prefix = max(candidates)
+        paths = {path for path in paths if not path.startswith(prefix)} | {f"{prefix}*"}
+    return sorted(paths)
+
+
+def get_invalidation_paths(changed_files, max_paths=DEFAULT_MAX_INVALIDATION_PATHS):
+    if changed_files is None:
+        return ["/*"]
+    paths = [
+        path for relative_path in changed_files for path in get_url_paths(relative_path)
+    ]
+    return collapse_invalidation_paths(paths, max_paths)
+
+
+@traced("deploy wiki")
 def deploy_s3_wiki(
     session,
     s3_bucket,
     distribution_config,
     build_path="../../wiki/dist",
     wiki_artifact_dir="",
+    upload_workers=DEFAULT_UPLOAD_WORKERS,
+    multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+    multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE,
+    precompress=DEFAULT_PRECOMPRESS,
+    force=False,
 ):
     version_old = get_current_wiki_version(distribution_config)
     version_new = datetime.datetime.now().replace(microsecond=0).isoformat()
     print("Current wiki version:", version_old)
 
+    # Skip the build and upload if the wiki did not change since the current version
+    build_path_abs = os.path.abspath(os.path.join(CURRENT_DIR, build_path))
+    s3 = get_s3_client(session, upload_workers)
+    old_manifest = load_manifest(s3, s3_bucket, version_old)
+    fingerprint = get_wiki_fingerprint(os.path.dirname(build_path_abs), precompress)
+    if not force and is_wiki_unchanged(old_manifest, fingerprint):
+        print(
+            f"Wiki is unchanged since version {version_old}, skipping build and upload "
+            "(force with --force-wiki-deploy)"
+        )
+        return distribution_config, []
+
     if not wiki_artifact_dir:
-        build_path_abs = os.path.abspath(os.path.join(CURRENT_DIR, build_path))
         # Build Astro wiki
-        subprocess.run(["npm", "run", "build"], cwd=os.path.join(build_path_abs, ".."))
+        with tracer.span("build wiki"):
+            subprocess.run(
+                ["npm", "run", "build"], cwd=os.path.join(build_path_abs, "..")
+            )
         wiki_artifact_dir = build_path_abs
 
-    # Upload build to S3 bucket as new version
-    s3 = session.client("s3")
-    print(f"Start S3 upload of version {version_new} to {s3_bucket}")
-    for root, dirs, files in os.walk(wiki_artifact_dir):
-        for filename in files:
-            local_path = os.path.join(root, filename)
-            relative_path = os.path.relpath(local_path, wiki_artifact_dir)
-            s3_path = os.path.join(version_new, relative_path)
-            mimetype = mimetypes.guess_type(local_path)[0]
-            extra_args = {}
-            if mimetype:
-                extra_args["ContentType"] = mimetype
-            print(f"Uploading {local_path} to {s3_path} with content-type {mimetype}")
-            s3.upload_file(local_path, s3_bucket, s3_path, ExtraArgs=extra_args)
+    # Upload build to S3 bucket as new version, copying unchanged files from the
+    # current version
+    new_manifest = build_manifest(
+        version_new, wiki_artifact_dir, precompress, fingerprint
+    )
+    uploads, copies = plan_wiki_transfer(old_manifest, new_manifest, wiki_artifact_dir)
+    print(
+        f"Start S3 upload of version {version_new} to {s3_bucket}: "
+        f"{len(uploads)} changed files, {len(copies)} unchanged files"
+    )
+    transfer_files(
+        s3,
+        s3_bucket,
+        uploads,
+        copies,
+        max_workers=upload_workers,
+        multipart_threshold=multipart_threshold,
+        multipart_chunksize=multipart_chunksize,
+    )
+    # The manifest is only written once the version is complete
+    save_manifest(s3, s3_bucket, new_manifest)
 
     # Serve new version on cloudfront
     new_path = version_new if version_new.startswith("/") else f"/{version_new}"
     distribution_config["Origins"]["Items"][0]["OriginPath"] = new_path
-    return distribution_config
+    return distribution_config, get_changed_files(old_manifest, new_manifest)
 
 
+@traced("update cloudfront")
 def update_cloudfront(
     session,
     cloudfront_distribution_id,
@@ -173,6 +860,8 @@ def update_cloudfront(
     etag,
     wait=True,
     invalidate=True,
+    invalidation_paths=("/*",),
+    wait_invalidation=True,
 ):
     cloudfront_client = session.client("cloudfront")
 
@@ -186,25 +875,234 @@ def update_cloudfront(
     if wait:
         print("Waiting for cloudfront deployment to finish")
         waiter = cloudfront_client.get_waiter("distribution_deployed")
-        waiter.wait(Id=cloudfront_distribution_id)
+        with tracer.span("wait distribution_deployed", "waiter"):
+            waiter.wait(Id=cloudfront_distribution_id)
         print("Cloudfront update done")
-    if invalidate:
-        print("Invalidating cloudfront distribution cache")
-        result = cloudfront_client.create_invalidation(
-            DistributionId=cloudfront_distribution_id,
-            InvalidationBatch={
-                "Paths": {"Quantity": 1, "Items": ["/*"]},
-                "CallerReference": datetime.datetime.now().isoformat(),
-            },
+    if invalidate and invalidation_paths:
+        invalidate_cloudfront(
+            session, cloudfront_distribution_id, invalidation_paths, wait_invalidation
         )
+
+
+@traced("invalidate cloudfront")
+def invalidate_cloudfront(
+    session, cloudfront_distribution_id, invalidation_paths, wait=True
+):
+    cloudfront_client = session.client("cloudfront")
+    tracer.annotate(paths=len(invalidation_paths))
+
+    print("Invalidating cloudfront distribution cache:", ", ".join(invalidation_paths))
+    result = cloudfront_client.create_invalidation(
+        DistributionId=cloudfront_distribution_id,
+        InvalidationBatch={
+            "Paths": {
+                "Quantity": len(invalidation_paths),
+                "Items": list(invalidation_paths),
+            },
+            "CallerReference": datetime.datetime.now().isoformat(),
+        },
+    )
+    if wait:
         waiter = cloudfront_client.get_waiter("invalidation_completed")
-        waiter.wait(
-            DistributionId=cloudfront_distribution_id, Id=result["Invalidation"]["Id"]
-        )
+        with tracer.span("wait invalidation_completed", "waiter"):
+            waiter.wait(
+                DistributionId=cloudfront_distribution_id,
+                Id=result["Invalidation"]["Id"],
+            )
         print("Cloudfront invalidation done")
+    else:
+        print("Cloudfront invalidation created", result["Invalidation"]["Id"])
 
 
-def main(
+def merge_distribution_configs(edge_distribution_config, wiki_distribution_config):
+    # The Lambda@Edge stage only updates the cache behaviors, the wiki stage the origins
+    distribution_config = copy.deepcopy(edge_distribution_config)
+    distribution_config["Origins"] = wiki_distribution_config["Origins"]
+    return distribution_config
+
+
+def is_wiki_version(name):
+    try:
+        datetime.datetime.fromisoformat(name)
+    except ValueError:
+        return False
+    return True
+
+
+def list_wiki_versions(s3, s3_bucket):
+    # The version prefixes in the bucket, ISO timestamps sort from old to new
+    versions = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=s3_bucket, Delimiter="/"):
+        for common_prefix in page.get("CommonPrefixes", []):
+            version = common_prefix["Prefix"].rstrip("/")
+            if is_wiki_version(version):
+                versions.append(version)
+    return sorted(versions)
+
+
+def get_expired_wiki_versions(versions, current_version, keep_versions):
+    # The current version is always kept, next to the most recent other versions
+    other_versions = sorted(
+        (version for version in versions if version != current_version),
+        reverse=True,
+    )
+    return other_versions[keep_versions:]
+
+
+@traced("delete objects", "s3")
+def delete_objects(s3, s3_bucket, keys):
+    tracer.annotate(objects=len(keys))
+    result = s3.delete_objects(
+        Bucket=s3_bucket,
+        Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+    )
+    for error in result.get("Errors", []):
+        print(
+            f"Failed to delete {error['Key']}: {error['Code']} {error['Message']}",
+            file=sys.stderr,
+        )
+    return len(keys) - len(result.get("Errors", []))
+
+
+def delete_wiki_versions(s3, s3_bucket, versions, max_workers=DEFAULT_UPLOAD_WORKERS):
+    if not versions:
+        return 0
+
+    # Manifests go first, so a partially deleted version is never offered for reuse
+    manifest_keys = [get_manifest_key(version) for version in versions]
+    for start in range(0, len(manifest_keys), DELETE_OBJECTS_LIMIT):
+        delete_objects(
+            s3, s3_bucket, manifest_keys[start : start + DELETE_OBJECTS_LIMIT]
+        )
+
+    # Every listed page holds at most 1000 keys, which is deleted as one batch while
+    # the next pages are listed
+    paginator = s3.get_paginator("list_objects_v2")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for version in versions:
+            for page in paginator.paginate(
+                Bucket=s3_bucket,
+                Prefix=f"{version}/",
+                PaginationConfig={"PageSize": DELETE_OBJECTS_LIMIT},
+            ):
+                keys = [content["Key"] for content in page.get("Contents", [])]
+                if keys:
+                    futures.append(executor.submit(delete_objects, s3, s3_bucket, keys))
+        return sum(future.result() for future in futures)
+
+
+@traced("collect garbage")
+def collect_garbage(
+    session,
+    s3_bucket,
+    distribution_config,
+    keep_versions=DEFAULT_KEEP_VERSIONS,
+    max_workers=DEFAULT_UPLOAD_WORKERS,
+):
+    current_version = get_current_wiki_version(distribution_config)
+    s3 = get_s3_client(session, max_workers)
+    versions = list_wiki_versions(s3, s3_bucket)
+    expired_versions = get_expired_wiki_versions(
+        versions, current_version, keep_versions
+    )
+    print(
+        f"Current wiki version: {current_version}, keeping "
+        f"{len(versions) - len(expired_versions)} of {len(versions)} versions"
+    )
+    if current_version in expired_versions:
+        raise RuntimeError(f"Refusing to delete the current version {current_version}")
+
+    start = time.monotonic()
+    deleted = delete_wiki_versions(s3, s3_bucket, expired_versions, max_workers)
+    tracer.annotate(versions=len(expired_versions), objects=deleted)
+    print(
+        f"Deleted {len(expired_versions)} versions ({deleted} files) in "
+        f"{time.monotonic() - start:.1f}s"
+    )
+
+
+def load_wiki_manifests(s3, s3_bucket, versions, max_workers=DEFAULT_UPLOAD_WORKERS):
+    # Manifests by version, a version without manifest was never completely uploaded
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        manifests = executor.map(
+            lambda version: load_manifest(s3, s3_bucket, version), versions
+        )
+        return {
+            version: manifest
+            for version, manifest in zip(versions, manifests)
+            if manifest is not None
+        }
+
+
+def print_wiki_versions(manifests, current_version):
+    for version, manifest in sorted(manifests.items(), reverse=True):
+        files = manifest["files"].values()
+        size = format_size(sum(entry["size"] for entry in files))
+        current = " (current)" if version == current_version else ""
+        print(f"{version}  {len(files):>6} files  {size:>10}{current}")
+
+
+@traced("rollback")
+def rollback(
+    session,
+    cloudfront_distribution_id,
+    wiki_bucket,
+    version="",
+    previous=False,
+    max_invalidation_paths=DEFAULT_MAX_INVALIDATION_PATHS,
+    wait_invalidation=True,
+):
+    distribution_config, etag = get_cloudfront_config(
+        session=session, cloudfront_distribution_id=cloudfront_distribution_id
+    )
+    current_version = get_current_wiki_version(distribution_config)
+    s3 = get_s3_client(session)
+    manifests = load_wiki_manifests(
+        s3, wiki_bucket, list_wiki_versions(s3, wiki_bucket)
+    )
+    print_wiki_versions(manifests, current_version)
+
+    if previous:
+        older_versions = [v for v in sorted(manifests) if v < current_version]
+        if not older_versions:
+            print(
+                "There is no retained version before the current one", file=sys.stderr
+            )
+            return False
+        version = older_versions[-1]
+    if not version:
+        return True
+    if version not in manifests:
+        print(f"Wiki version {version} is not retained", file=sys.stderr)
+        return False
+    if version == current_version:
+        print(f"Wiki version {version} is already the current version")
+        return True
+
+    print(f"Rolling back wiki version {current_version} to {version}")
+    distribution_config["Origins"]["Items"][0]["OriginPath"] = f"/{version}"
+    changed_files = get_changed_files(
+        manifests.get(current_version), manifests[version]
+    )
+    update_cloudfront(
+        session=session,
+        cloudfront_distribution_id=cloudfront_distribution_id,
+        distribution_config=distribution_config,
+        etag=etag,
+        wait=True,
+        invalidate=True,
+        invalidation_paths=get_invalidation_paths(
+            changed_files, max_invalidation_paths
+        ),
+        wait_invalidation=wait_invalidation,
+    )
+    return True
+
+
+@traced("plan")
+def plan_deploy(
     session,
     session_us_east_1,
     cognito_region,
@@ -212,18 +1110,24 @@ def main(
     user_pool_app_id,
     user_pool_app_secret,
     user_pool_domain,
-    cloudfront_distribution_id,
+    distribution_config,
     wiki_bucket,
     function_prefix="wiki-",
     function_postfix="",
     lambda_edge_artifact_dir="",
     wiki_artifact_dir="",
+    build_path="../../wiki/dist",
+    precompress=DEFAULT_PRECOMPRESS,
+    max_invalidation_paths=DEFAULT_MAX_INVALIDATION_PATHS,
+    rotate_nonce_secret=False,
+    force_wiki_deploy=False,
 ):
-    distribution_config, etag = get_cloudfront_config(
-        session=session, cloudfront_distribution_id=cloudfront_distribution_id
-    )
-    distribution_config = deploy_edge_lambdas(
-        session_us_east_1=session_us_east_1,
+    # The work a deploy would do, only reading from AWS. Nothing is built, the
+    # artifact dirs default to the output of an earlier build.
+    if not lambda_edge_artifact_dir:
+        lambda_edge_artifact_dir = os.path.join(CURRENT_DIR, "lambda-edge", "src")
+    packages = plan_edge_lambdas(
+        session_us_east_1.client("lambda"),
         cognito_region=cognito_region,
         user_pool_id=user_pool_id,
         user_pool_app_id=user_pool_app_id,
@@ -233,20 +1137,203 @@ def main(
         function_prefix=function_prefix,
         function_postfix=function_postfix,
         lambda_edge_artifact_dir=lambda_edge_artifact_dir,
+        rotate_nonce_secret=rotate_nonce_secret,
     )
-    distribution_config = deploy_s3_wiki(
-        session=session,
-        s3_bucket=wiki_bucket,
-        distribution_config=distribution_config,
-        wiki_artifact_dir=wiki_artifact_dir,
+    if not packages:
+        print(
+            f"Lambda@Edge is not built in {lambda_edge_artifact_dir}", file=sys.stderr
+        )
+        return None
+    plan = {
+        "lambdas": {
+            function_name: unchanged_arn is None
+            for function_name, _, unchanged_arn in packages
+        },
+        "wiki_version": get_current_wiki_version(distribution_config),
+        "wiki_unchanged": False,
+        "uploads": [],
+        "copies": [],
+        "invalidation_paths": [],
+    }
+
+    build_path_abs = os.path.abspath(os.path.join(CURRENT_DIR, build_path))
+    s3 = get_s3_client(session)
+    old_manifest = load_manifest(s3, wiki_bucket, plan["wiki_version"])
+    fingerprint = get_wiki_fingerprint(os.path.dirname(build_path_abs), precompress)
+    if not force_wiki_deploy and is_wiki_unchanged(old_manifest, fingerprint):
+        plan["wiki_unchanged"] = True
+        return plan
+
+    wiki_artifact_dir = wiki_artifact_dir or build_path_abs
+    if not os.path.isdir(wiki_artifact_dir):
+        print(f"Wiki is not built in {wiki_artifact_dir}", file=sys.stderr)
+        return None
+    new_manifest = build_manifest("plan", wiki_artifact_dir, precompress, fingerprint)
+    uploads, copies = plan_wiki_transfer(old_manifest, new_manifest, wiki_artifact_dir)
+    plan["uploads"] = [
+        (s3_path.split("/", 1)[1], os.path.getsize(local_path))
+        for local_path, s3_path, _ in uploads
+    ]
+    plan["copies"] = [(s3_path.split("/", 1)[1], size) for _, s3_path, size in copies]
+    plan["invalidation_paths"] = get_invalidation_paths(
+        get_changed_files(old_manifest, new_manifest), max_invalidation_paths
     )
-    update_cloudfront(
+    return plan
+
+
+def print_deploy_plan(plan):
+    for function_name, changed in sorted(plan["lambdas"].items()):
+        print(
+            f"Lambda {function_name}: "
+            + ("publish a new version" if changed else "unchanged")
+        )
+    if plan["wiki_unchanged"]:
+        print(f"Wiki: unchanged since version {plan['wiki_version']}")
+    else:
+        upload_size = sum(size for _, size in plan["uploads"])
+        copy_size = sum(size for _, size in plan["copies"])
+        print(
+            f"Wiki: upload {len(plan['uploads'])} files ({format_size(upload_size)} "
+            f"before compression), copy {len(plan['copies'])} files "
+            f"({format_size(copy_size)}) from version {plan['wiki_version'] or '-'}"
+        )
+        for relative_path, size in sorted(plan["uploads"]):
+            print(f"  upload {relative_path} ({format_size(size)})")
+    print("Cloudfront invalidation:", ", ".join(plan["invalidation_paths"]) or "none")
+
+
+def main(
+    session,
+    session_us_east_1,
+    cognito_region,
+    user_pool_id,
+    user_pool_app_id,
+    user_pool_app_secret,
+    user_pool_domain,
+    cloudfront_distribution_id,
+    wiki_bucket,
+    function_prefix="wiki-",
+    function_postfix="",
+    lambda_edge_artifact_dir="",
+    wiki_artifact_dir="",
+    upload_workers=DEFAULT_UPLOAD_WORKERS,
+    multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+    multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE,
+    precompress=DEFAULT_PRECOMPRESS,
+    max_invalidation_paths=DEFAULT_MAX_INVALIDATION_PATHS,
+    wait_invalidation=True,
+    rotate_nonce_secret=False,
+    keep_versions=None,
+    force_wiki_deploy=False,
+    plan=False,
+):
+    distribution_config, etag = get_cloudfront_config(
+        session=session, cloudfront_distribution_id=cloudfront_distribution_id
+    )
+    if plan:
+        deploy_plan = plan_deploy(
+            session,
+            session_us_east_1,
+            cognito_region=cognito_region,
+            user_pool_id=user_pool_id,
+            user_pool_app_id=user_pool_app_id,
+            user_pool_app_secret=user_pool_app_secret,
+            user_pool_domain=user_pool_domain,
+            distribution_config=distribution_config,
+            wiki_bucket=wiki_bucket,
+            function_prefix=function_prefix,
+            function_postfix=function_postfix,
+            lambda_edge_artifact_dir=lambda_edge_artifact_dir,
+            wiki_artifact_dir=wiki_artifact_dir,
+            precompress=precompress,
+            max_invalidation_paths=max_invalidation_paths,
+            rotate_nonce_secret=rotate_nonce_secret,
+            force_wiki_deploy=force_wiki_deploy,
+        )
+        if deploy_plan:
+            print_deploy_plan(deploy_plan)
+        return deploy_plan
+
+    # The Lambda@Edge and wiki stages are independent until the cloudfront update, so
+    # they run concurrently, each on their own copy of the distribution config
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        edge_future = executor.submit(
+            deploy_edge_lambdas,
+            session_us_east_1=session_us_east_1,
+            cognito_region=cognito_region,
+            user_pool_id=user_pool_id,
+            user_pool_app_id=user_pool_app_id,
+            user_pool_app_secret=user_pool_app_secret,
+            user_pool_domain=user_pool_domain,
+            distribution_config=copy.deepcopy(distribution_config),
+            function_prefix=function_prefix,
+            function_postfix=function_postfix,
+            lambda_edge_artifact_dir=lambda_edge_artifact_dir,
+            rotate_nonce_secret=rotate_nonce_secret,
+        )
+        wiki_future = executor.submit(
+            deploy_s3_wiki,
+            session=session,
+            s3_bucket=wiki_bucket,
+            distribution_config=copy.deepcopy(distribution_config),
+            wiki_artifact_dir=wiki_artifact_dir,
+            upload_workers=upload_workers,
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            precompress=precompress,
+            force=force_wiki_deploy,
+        )
+    edge_distribution_config = edge_future.result()
+    wiki_distribution_config, changed_files = wiki_future.result()
+    new_distribution_config = merge_distribution_configs(
+        edge_distribution_config, wiki_distribution_config
+    )
+    if new_distribution_config == distribution_config:
+        print("Cloudfront distribution is unchanged")
+    else:
+        distribution_config = new_distribution_config
+        update_cloudfront(
+            session=session,
+            cloudfront_distribution_id=cloudfront_distribution_id,
+            distribution_config=distribution_config,
+            etag=etag,
+            wait=True,
+            invalidate=True,
+            invalidation_paths=get_invalidation_paths(
+                changed_files, max_invalidation_paths
+            ),
+            wait_invalidation=wait_invalidation,
+        )
+    if keep_versions is not None:
+        collect_garbage(
+            session=session,
+            s3_bucket=wiki_bucket,
+            distribution_config=distribution_config,
+            keep_versions=keep_versions,
+            max_workers=upload_workers,
+        )
+
+
+@contextlib.contextmanager
+def traced_command(trace_path, command):
+    # Writes the trace when the command finishes, also if it fails
+    try:
+        with tracer.span(command, "command"):
+            yield
+    finally:
+        if trace_path:
+            tracer.write(trace_path)
+
+
+def run_gc(session, cloudfront_distribution_id, wiki_bucket, **kwargs):
+    distribution_config, _ = get_cloudfront_config(
+        session=session, cloudfront_distribution_id=cloudfront_distribution_id
+    )
+    collect_garbage(
         session=session,
-        cloudfront_distribution_id=cloudfront_distribution_id,
+        s3_bucket=wiki_bucket,
         distribution_config=distribution_config,
-        etag=etag,
-        wait=True,
-        invalidate=False,
+        **kwargs,
     )
 
 
@@ -258,33 +1345,190 @@ if __name__ == "__main__":
         sys.exit(1)
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--cognito-region", required=True)
-    parser.add_argument("--user-pool-id", required=True)
-    parser.add_argument("--user-pool-domain", required=True)
-    parser.add_argument("--user-pool-app-id", required=True)
-    parser.add_argument("--user-pool-app-secret", required=True)
-    parser.add_argument("--cloudfront-distribution-id", required=True)
-    parser.add_argument("--wiki-bucket", required=True)
-    parser.add_argument("--function-prefix", default="wiki-")
-    parser.add_argument("--function-postfix", default="")
-    parser.add_argument("--wiki-artifact-dir", default="", required=False)
-    parser.add_argument("--lambda-edge-artifact-dir", default="", required=False)
-    args = parser.parse_args()
+    subparsers = parser.add_subparsers(
+        required=True,
+        title="commands",
+        description="Different commands that can be executed",
+    )
+
+    # Arguments shared by the commands
+    distribution_parser = argparse.ArgumentParser(add_help=False)
+    distribution_parser.add_argument("--cloudfront-distribution-id", required=True)
+    distribution_parser.add_argument("--wiki-bucket", required=True)
+    distribution_parser.add_argument(
+        "--trace",
+        default="",
+        required=False,
+        help="Write the spans of the stages and AWS calls to this Chrome trace file",
+    )
+    invalidation_parser = argparse.ArgumentParser(add_help=False)
+    invalidation_parser.add_argument(
+        "--max-invalidation-paths",
+        type=int,
+        default=DEFAULT_MAX_INVALIDATION_PATHS,
+        required=False,
+        help="Number of cloudfront invalidation paths beyond which paths are collapsed into wildcards",
+    )
+    invalidation_parser.add_argument(
+        "--no-wait-invalidation",
+        dest="wait_invalidation",
+        action="store_false",
+        help="Do not wait for the cloudfront invalidation to complete",
+    )
+
+    parser_deploy = subparsers.add_parser(
+        "deploy",
+        help="Deploy the Lambda@Edge functions and the wiki",
+        parents=[distribution_parser, invalidation_parser],
+    )
+    parser_deploy.add_argument("--cognito-region", required=True)
+    parser_deploy.add_argument("--user-pool-id", required=True)
+    parser_deploy.add_argument("--user-pool-domain", required=True)
+    parser_deploy.add_argument("--user-pool-app-id", required=True)
+    parser_deploy.add_argument("--user-pool-app-secret", required=True)
+    parser_deploy.add_argument("--function-prefix", default="wiki-")
+    parser_deploy.add_argument("--function-postfix", default="")
+    parser_deploy.add_argument("--wiki-artifact-dir", default="", required=False)
+    parser_deploy.add_argument("--lambda-edge-artifact-dir", default="", required=False)
+    parser_deploy.add_argument(
+        "--upload-workers", type=int, default=DEFAULT_UPLOAD_WORKERS, required=False
+    )
+    parser_deploy.add_argument(
+        "--multipart-threshold",
+        type=int,
+        default=DEFAULT_MULTIPART_THRESHOLD,
+        required=False,
+        help="Size in bytes from which files are uploaded in multiple parts",
+    )
+    parser_deploy.add_argument(
+        "--multipart-chunksize",
+        type=int,
+        default=DEFAULT_MULTIPART_CHUNKSIZE,
+        required=False,
+        help="Size in bytes of the parts of a multipart upload",
+    )
+    parser_deploy.add_argument(
+        "--precompress",
+        choices=["gzip", "br", "none"],
+        default=DEFAULT_PRECOMPRESS,
+        required=False,
+        help="Encoding in which text files are stored, all clients must accept it",
+    )
+    parser_deploy.add_argument(
+        "--rotate-nonce-secret",
+        action="store_true",
+        help="Sign the Lambda@Edge nonces with a new secret, this republishes the lambda",
+    )
+    parser_deploy.add_argument(
+        "--keep-versions",
+        type=int,
+        default=None,
+        required=False,
+        help="Delete all but the current and this number of most recent wiki versions after the deploy",
+    )
+    parser_deploy.add_argument(
+        "--force-wiki-deploy",
+        action="store_true",
+        help="Build and upload the wiki, even if it did not change since the current version",
+    )
+    parser_deploy.add_argument(
+        "--plan",
+        action="store_true",
+        help="Only print the work the deploy would do, without building or changing anything",
+    )
+    parser_deploy.set_defaults(command="deploy")
+
+    parser_gc = subparsers.add_parser(
+        "gc",
+        help="Delete all but the current and the most recent wiki versions from the bucket",
+        parents=[distribution_parser],
+    )
+    parser_gc.add_argument(
+        "--keep-versions", type=int, default=DEFAULT_KEEP_VERSIONS, required=False
+    )
+    parser_gc.add_argument(
+        "--workers", type=int, default=DEFAULT_UPLOAD_WORKERS, required=False
+    )
+    parser_gc.set_defaults(command="gc")
+
+    parser_rollback = subparsers.add_parser(
+        "rollback",
+        help="List the retained wiki versions, or serve one of them again",
+        parents=[distribution_parser, invalidation_parser],
+    )
+    rollback_version = parser_rollback.add_mutually_exclusive_group()
+    rollback_version.add_argument(
+        "--version", default="", help="The retained wiki version to serve"
+    )
+    rollback_version.add_argument(
+        "--previous",
+        action="store_true",
+        help="Serve the most recent retained wiki version before the current one",
+    )
+    parser_rollback.set_defaults(command="rollback")
 
+    args = parser.parse_args()
     session = boto3.session.Session()
     session_us_east_1 = boto3.session.Session(region_name="us-east-1")
-    main(
-        session,
-        session_us_east_1,
-        cognito_region=args.cognito_region,
-        user_pool_id=args.user_pool_id,
-        user_pool_domain=args.user_pool_domain,
-        user_pool_app_id=args.user_pool_app_id,
-        user_pool_app_secret=args.user_pool_app_secret,
-        cloudfront_distribution_id=args.cloudfront_distribution_id,
-        wiki_bucket=args.wiki_bucket,
-        function_prefix=args.function_prefix,
-        function_postfix=args.function_postfix,
-        lambda_edge_artifact_dir=args.lambda_edge_artifact_dir,
-        wiki_artifact_dir=args.wiki_artifact_dir,
-    )
+    if args.trace:
+        tracer.instrument(session)
+        tracer.instrument(session_us_east_1)
+
+    if args.command == "gc":
+        with traced_command(args.trace, args.command):
+            run_gc(
+                session,
+                cloudfront_distribution_id=args.cloudfront_distribution_id,
+                wiki_bucket=args.wiki_bucket,
+                keep_versions=args.keep_versions,
+                max_workers=args.workers,
+            )
+        sys.exit(0)
+    if args.command == "rollback":
+        with traced_command(args.trace, args.command):
+            success = rollback(
+                session,
+                cloudfront_distribution_id=args.cloudfront_distribution_id,
+                wiki_bucket=args.wiki_bucket,
+                version=args.version,
+                previous=args.previous,
+                max_invalidation_paths=args.max_invalidation_paths,
+                wait_invalidation=args.wait_invalidation,
+            )
+        sys.exit(0 if success else 1)
+
+    if args.precompress == "br":
+        try:
+            import brotli
+        except ImportError:
+            print("Brotli is required to precompress with br.", file=sys.stderr)
+            sys.exit(1)
+
+    with traced_command(args.trace, args.command):
+        deploy_plan = main(
+            session,
+            session_us_east_1,
+            cognito_region=args.cognito_region,
+            user_pool_id=args.user_pool_id,
+            user_pool_domain=args.user_pool_domain,
+            user_pool_app_id=args.user_pool_app_id,
+            user_pool_app_secret=args.user_pool_app_secret,
+            cloudfront_distribution_id=args.cloudfront_distribution_id,
+            wiki_bucket=args.wiki_bucket,
+            function_prefix=args.function_prefix,
+            function_postfix=args.function_postfix,
+            lambda_edge_artifact_dir=args.lambda_edge_artifact_dir,
+            wiki_artifact_dir=args.wiki_artifact_dir,
+            upload_workers=args.upload_workers,
+            multipart_threshold=args.multipart_threshold,
+            multipart_chunksize=args.multipart_chunksize,
+            precompress=args.precompress if args.precompress != "none" else "",
+            max_invalidation_paths=args.max_invalidation_paths,
+            wait_invalidation=args.wait_invalidation,
+            rotate_nonce_secret=args.rotate_nonce_secret,
+            keep_versions=args.keep_versions,
+            force_wiki_deploy=args.force_wiki_deploy,
+            plan=args.plan,
+        )
+    if args.plan and not deploy_plan:
+        sys.exit(1)
@@ -5,23 +5,79 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import json
 import logging
+import math
 import os
+import random
+import re
+import stat
 import subprocess
 import sys
-
+import tempfile
+import threading
+import time
 
 logging.basicConfig(level=logging.INFO, stream=sys.stderr)
 logger = logging.getLogger()
 
+DEFAULT_AI_SERVICE = "google"
+DEFAULT_CACHE_DIR = ".polgen-cache"
+DEFAULT_JOURNAL_PATH = os.path.join(DEFAULT_CACHE_DIR, "journal.jsonl")
+FILE_CHUNK_SIZE = 64 * 1024
+# HTTP status codes of AI service errors that are worth retrying
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# Rough number of characters per token, used to estimate the size of a request
+CHARACTERS_PER_TOKEN = 4
+# Number of finished requests of a kind needed before its latency percentiles are used
+HEDGE_MIN_SAMPLES = 5
+HEDGE_MAX_SAMPLES = 100
+# Interval in seconds at which running requests are checked for hedging
+HEDGE_POLL_INTERVAL = 0.5
+# The system prompt asks for the policy metadata to be wrapped in <small> tags
+METADATA_HEADER_PATTERN = re.compile(r"<small>.*?</small>", re.DOTALL)
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+# Changes to these policy fields can be applied to the existing markdown in edit mode
+EDITABLE_POLICY_FIELDS = {"requirements", "framework_requirements"}
+# The sections of a policy as defined in the system prompt, with the parts of the
+# structured policy each section depends on. The Checklist summarizes the Policy
+# Requirement Details instead.
+POLICY_SECTIONS = [
+    ("1. Introduction & Purpose", [["context"], ["policy"]], None),
+    ("2. Scope", [["context"], ["policy"]], None),
+    ("3. Checklist", [["policy", "name"]], "4. Policy Requirement Details"),
+    ("4. Policy Requirement Details", [["context"], ["policy"]], None),
+    ("5. Responsibilities", [["context"], ["policy"]], None),
+    ("6. Policy Enforcement & Non-Compliance", [["context"], ["policy", "name"]], None),
+    ("7. Questions & Support", [["context"], ["policy", "name"]], None),
+]
+SECTION_INSTRUCTIONS = """Only write the section "%(title)s" of the policy, starting with the heading "## %(title)s".
+Do not write the frontmatter, the metadata header or any other section.
+"""
+EDIT_INSTRUCTIONS = """The structured json policy below was already turned into the markdown policy below. Since then,
+only the policy requirements listed in the structured diff changed.
+
+Return only the sections of the markdown policy that must change to reflect the diff, including the Checklist if it
+summarizes a changed requirement. Return every changed section in full, starting with its heading line exactly as it
+appears in the current markdown. Do not return unchanged sections, the frontmatter or the metadata header.
+"""
 
 ai_service = None
+selected_ai_service = None
+ai_service_lock = threading.Lock()
+scheduler = None
 
 
 def get_changed_files(base_ref: str) -> list[str]:
     try:
         result = subprocess.run(
-            ["git", "diff", "--name-only", base_ref],
+            # Deleted files have nothing left to generate
+            ["git", "diff", "--name-only", "--diff-filter=d", base_ref],
             check=True,
             capture_output=True,
             text=True,
@@ -45,7 +101,457 @@ def get_system_prompt():
         return f.read()
 
 
-class GoogleGenAI:
+def read_policy(policy):
+    with open(policy) as f:
+        return f.read()
+
+
+def get_base_file(base_ref, path):
+    try:
+        result = subprocess.run(
+            ["git", "show", f"{base_ref}:{path}"],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except subprocess.CalledProcessError:
+        logger.debug(f"{path} does not exist in {base_ref}")
+        return None
+    return result.stdout
+
+
+def get_last_commit(path):
+    # None in a shallow clone, where the history of the file is not available
+    try:
+        shallow = subprocess.run(
+            ["git", "rev-parse", "--is-shallow-repository"],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        if shallow.stdout.strip() != "false":
+            return None
+        result = subprocess.run(
+            ["git", "log", "-1", "--format=%H", "--", path],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except subprocess.CalledProcessError:
+        return None
+    return result.stdout.strip() or None
+
+
+def get_changed_sections(base_policy, policy):
+    return {
+        section
+        for section in base_policy.keys() | policy.keys()
+        if base_policy.get(section) != policy.get(section)
+    }
+
+
+def render_metadata_header(markdown, base_metadata, metadata):
+    # Rewrite the changed metadata values in the existing header. Returns None when
+    # this can not be done unambiguously, in which case the policy must be regenerated.
+    if base_metadata.keys() != metadata.keys():
+        return None
+    match = METADATA_HEADER_PATTERN.search(markdown)
+    if not match:
+        return None
+    header = match.group(0)
+
+    replacements = []
+    for key, value in metadata.items():
+        base_value = str(base_metadata[key])
+        value = str(value)
+        if value == base_value:
+            continue
+        occurrences = list(
+            re.finditer(rf"(?<!\w){re.escape(base_value)}(?!\w)", header, re.IGNORECASE)
+        )
+        if not base_value or len(occurrences) != 1:
+            return None
+        occurrence = occurrences[0]
+        if occurrence.group(0) != base_value and occurrence.group(0)[0].isupper():
+            # Keep the capitalization the model used, e.g. "Draft" for "draft"
+            value = value[:1].upper() + value[1:]
+        replacements.append((occurrence.start(), occurrence.end(), value))
+
+    replacements.sort()
+    for (_, end, _), (start, _, _) in zip(replacements, replacements[1:]):
+        if start < end:
+            return None
+    for start, end, value in reversed(replacements):
+        header = header[:start] + value + header[end:]
+    return markdown[: match.start()] + header + markdown[match.end() :]
+
+
+def diff_policy_items(base_items, items):
+    return {
+        "added": [item for item in items if item not in base_items],
+        "removed": [item for item in base_items if item not in items],
+    }
+
+
+def get_requirements_diff(base_policy, policy):
+    # Returns None if anything other than the requirements of the policy changed
+    if get_changed_sections(base_policy, policy) - {"policy", "metadata"}:
+        return None
+    base_fields = base_policy.get("policy", {})
+    fields = policy.get("policy", {})
+    changed_fields = get_changed_sections(base_fields, fields)
+    if not changed_fields or changed_fields - EDITABLE_POLICY_FIELDS:
+        return None
+    return {
+        field: diff_policy_items(base_fields.get(field, []), fields.get(field, []))
+        for field in sorted(changed_fields)
+    }
+
+
+def split_sections(markdown):
+    # Split the markdown on its top level headings, ignoring "#" lines in code blocks.
+    # Returns the content before the first section and a list of (heading, content).
+    lines = markdown.splitlines(keepends=True)
+    headings = []
+    in_code_block = False
+    for index, line in enumerate(lines):
+        if line.lstrip().startswith("```"):
+            in_code_block = not in_code_block
+            continue
+        match = HEADING_PATTERN.match(line)
+        if match and not in_code_block:
+            headings.append((index, len(match.group(1)), match.group(2)))
+    if not headings:
+        return markdown, []
+
+    level = min(heading_level for _, heading_level, _ in headings)
+    starts = [
+        (index, title)
+        for index, heading_level, title in headings
+        if heading_level == level
+    ]
+    preamble = "".join(lines[: starts[0][0]])
+    sections = []
+    for (start, title), (end, _) in zip(starts, starts[1:] + [(len(lines), None)]):
+        sections.append((title, "".join(lines[start:end])))
+    return preamble, sections
+
+
+def normalize_heading(title):
+    return " ".join(title.split()).lower()
+
+
+def apply_section_patch(markdown, patch):
+    # Replace the sections of the markdown with the sections returned by the model.
+    # Returns None if the patch does not consist of known sections.
+    preamble, sections = split_sections(markdown)
+    _, patched_sections = split_sections(patch)
+    if not sections or not patched_sections:
+        return None
+    replacements = {}
+    known_titles = {normalize_heading(title) for title, _ in sections}
+    for title, content in patched_sections:
+        if normalize_heading(title) not in known_titles:
+            return None
+        replacements[normalize_heading(title)] = content
+    patched = [
+        replacements.get(normalize_heading(title), content)
+        for title, content in sections
+    ]
+    # Keep the blank line between sections if the model did not end with one
+    for index, content in enumerate(patched[:-1]):
+        if not content.endswith("\n\n"):
+            patched[index] = content.rstrip("\n") + "\n\n"
+    if not patched[-1].endswith("\n"):
+        patched[-1] += "\n"
+    return preamble + "".join(patched)
+
+
+def get_edit_request(markdown, policy_json, requirements_diff):
+    return "\n".join(
+        [
+            EDIT_INSTRUCTIONS,
+            "Structured diff:",
+            json.dumps(requirements_diff, indent=2, ensure_ascii=False),
+            "",
+            "Structured json policy:",
+            policy_json,
+            "",
+            "Current markdown policy:",
+            markdown,
+        ]
+    )
+
+
+def select_policy_fields(policy, field_paths):
+    selection = {}
+    for field_path in field_paths:
+        value = policy
+        for field in field_path:
+            value = value.get(field) if isinstance(value, dict) else None
+        target = selection
+        for field in field_path[:-1]:
+            target = target.setdefault(field, {})
+        target[field_path[-1]] = value
+    return selection
+
+
+def get_section_request(title, section_input, derived_from=None, derived_content=""):
+    parts = [SECTION_INSTRUCTIONS % {"title": title}]
+    if derived_from:
+        parts += [
+            f'Derive it from the section "{derived_from}" of the policy:',
+            derived_content,
+        ]
+    parts += [
+        "Structured json policy:",
+        json.dumps(section_input, indent=2, ensure_ascii=False),
+    ]
+    return "\n".join(parts)
+
+
+def render_policy_header(policy):
+    metadata = policy.get("metadata", {})
+    header = [
+        "---",
+        # A JSON string is a valid YAML string
+        f"title: {json.dumps(policy.get('policy', {}).get('name', ''), ensure_ascii=False)}",
+        "---",
+        "",
+    ]
+    if metadata:
+        fields = [
+            f"{key.replace('_', ' ').capitalize()}: {value}"
+            for key, value in metadata.items()
+        ]
+        header += [f"<small>{' · '.join(fields)}</small>", ""]
+    return "\n".join(header) + "\n"
+
+
+def normalize_policy(policy_json):
+    # Formatting and key order do not change the meaning of a policy
+    return json.dumps(
+        json.loads(policy_json),
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+
+
+umask_lock = threading.Lock()
+
+
+def get_file_mode(path):
+    # The mode of the existing file, or the mode open() would create it with
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        pass
+    # The umask can only be read by setting it
+    with umask_lock:
+        umask = os.umask(0)
+        os.umask(umask)
+    return 0o666 & ~umask
+
+
+def write_temporary(path, chunks):
+    # Stream into a temporary file next to the target, so it can be moved into place
+    # once complete and the target is never left half-written
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file readable by the owner only
+        os.chmod(tmp_path, get_file_mode(path))
+    except BaseException:
+        remove_temporary(tmp_path)
+        raise
+    return tmp_path
+
+
+def remove_temporary(tmp_path):
+    # The file may already have been cleaned up after its request was abandoned
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(tmp_path)
+
+
+def remove_abandoned_temporaries(path):
+    for tmp_path in glob.glob(
+        os.path.join(
+            glob.escape(os.path.dirname(path)), f".{os.path.basename(path)}.*.tmp"
+        )
+    ):
+        logger.debug(f"Removing temporary file {tmp_path} of an abandoned request")
+        remove_temporary(tmp_path)
+
+
+def write_atomic(path, chunks):
+    os.replace(write_temporary(path, chunks), path)
+
+
+def read_chunks(path):
+    with open(path) as f:
+        while chunk := f.read(FILE_CHUNK_SIZE):
+            yield chunk
+
+
+def get_file_hash(path):
+    # None if the file does not exist
+    file_hash = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(FILE_CHUNK_SIZE):
+                file_hash.update(chunk)
+    except FileNotFoundError:
+        return None
+    return file_hash.hexdigest()
+
+
+def get_generation_key(system, policy_json, model):
+    key_input = json.dumps(
+        {
+            "model": model,
+            "system": system,
+            "policy": normalize_policy(policy_json),
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(key_input.encode("utf-8")).hexdigest()
+
+
+def get_section_key(system, title, section_request, model):
+    key_input = json.dumps(
+        {
+            "model": model,
+            "system": system,
+            "section": title,
+            "request": section_request,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(key_input.encode("utf-8")).hexdigest()
+
+
+# Content-addressed store of generated markdown, keyed on all inputs of a generation
+class GenerationCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.md")
+
+    def get(self, key):
+        path = self.get_path(key)
+        if os.path.exists(path):
+            return path
+        return None
+
+    def put(self, key, chunks):
+        write_atomic(self.get_path(key), chunks)
+
+    # The policy JSON each markdown was generated from, by the sha256 of the markdown
+    def get_source_path(self, markdown_hash):
+        return os.path.join(self.cache_dir, "sources", f"{markdown_hash}.json")
+
+    def get_source(self, markdown_hash):
+        try:
+            with open(self.get_source_path(markdown_hash)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_source(self, markdown_hash, policy_json):
+        write_atomic(self.get_source_path(markdown_hash), [policy_json])
+
+
+# Append-only record of the policies a run has finished, used to resume an interrupted run
+class GenerationJournal:
+    def __init__(self, path=DEFAULT_JOURNAL_PATH, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed = self.load() if resume else {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a" if resume else "w")
+
+    def load(self):
+        completed = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last entry may be incomplete if the previous run was killed
+                        continue
+                    completed[entry["policy"]] = (entry["key"], entry.get("sha256"))
+        except FileNotFoundError:
+            logger.info(f"No journal found at {self.path}, nothing to resume")
+        return completed
+
+    def is_completed(self, policy, key, markdown_path):
+        # The markdown must still be the one the run wrote, e.g. it is not when the
+        # commit of the generated markdown was never pushed
+        completed_key, markdown_hash = self.completed.get(policy, (None, None))
+        return (
+            completed_key == key
+            and markdown_hash is not None
+            and get_file_hash(markdown_path) == markdown_hash
+        )
+
+    def record(self, policy, key, markdown_path):
+        entry = {
+            "policy": policy,
+            "key": key,
+            "markdown_path": markdown_path,
+            "sha256": get_file_hash(markdown_path),
+        }
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class AIServiceError(Exception):
+    def __init__(self, message: str, code: int = 0):
+        super().__init__(message)
+        self.code = code
+
+
+# Interface of the AI services that generate the policies
+class AIService:
+    model = ""
+
+    def stream(self, system, policy, usage=None):
+        # Yields the generated text in chunks, and fills usage with the number of
+        # input_tokens and output_tokens when known
+        raise NotImplementedError
+
+    def generate(self, system, policy, usage=None):
+        return "".join(self.stream(system, policy, usage=usage))
+
+
+class GoogleGenAI(AIService):
+    model = "gemini-2.5-flash-preview-05-20"
+
     def __init__(self):
         try:
             from google import genai
@@ -63,12 +569,11 @@ class GoogleGenAI:
             from google.genai import types
 
             logger.info("Google genai library installed")
-        self.model = "gemini-2.5-flash-preview-05-20"
         self.client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
         self.genai = genai
         self.types = types
 
-    def generate(self, system, policy):
+    def stream(self, system, policy, usage=None):
         generate_content_config = self.types.GenerateContentConfig(
             response_mime_type="text/plain",
             system_instruction=[self.types.Part.from_text(text=system)],
@@ -81,59 +586,1055 @@ class GoogleGenAI:
                 ],
             ),
         ]
-        document = ""
         for chunk in self.client.models.generate_content_stream(
             model=self.model,
             contents=contents,
             config=generate_content_config,
         ):
-            document += chunk.text
-        return document
+            if usage is not None and chunk.usage_metadata:
+                usage["input_tokens"] = chunk.usage_metadata.prompt_token_count or 0
+                usage["output_tokens"] = (
+                    chunk.usage_metadata.candidates_token_count or 0
+                )
+            if chunk.text:
+                yield chunk.text
+
+
+# Local stand-in for a real AI service, to run and benchmark the generation pipeline
+# without network access. Produces deterministic output for the same input.
+class FakeGenAI(AIService):
+    model = "fake"
+
+    WORDS = (
+        "security team company data access password device policy incident review "
+        "owner account system risk protect report support update control keep safe"
+    ).split()
+
+    def __init__(self):
+        self.latency = float(os.environ.get("POLGEN_FAKE_LATENCY", "0.5"))
+        self.chunk_latency = float(os.environ.get("POLGEN_FAKE_CHUNK_LATENCY", "0.02"))
+        self.chunk_size = int(os.environ.get("POLGEN_FAKE_CHUNK_SIZE", "200"))
+        self.document_size = int(os.environ.get("POLGEN_FAKE_DOCUMENT_SIZE", "8000"))
+        self.error_rate = float(os.environ.get("POLGEN_FAKE_ERROR_RATE", "0"))
+        self.stall_rate = float(os.environ.get("POLGEN_FAKE_STALL_RATE", "0"))
+        self.stall_latency = float(os.environ.get("POLGEN_FAKE_STALL_LATENCY", "60"))
+        self.seed = os.environ.get("POLGEN_FAKE_SEED", "polgen")
+        # Errors and stalls differ per request, unlike the output
+        self.random = random.Random(self.seed)
+
+    def render_section(self, rng, title, size):
+        lines = [f"## {title}", ""]
+        while sum(len(line) + 1 for line in lines) < size:
+            sentence = " ".join(
+                rng.choice(self.WORDS) for _ in range(rng.randint(6, 14))
+            )
+            lines.append(sentence.capitalize() + ".")
+        return "\n".join(lines) + "\n"
+
+    def render(self, system, policy):
+        rng = random.Random(
+            hashlib.sha256(f"{self.seed}\n{system}\n{policy}".encode("utf-8")).digest()
+        )
+        section = re.search(r'starting with the heading "## (.*?)"', policy)
+        if section:
+            return self.render_section(rng, section.group(1), self.document_size // 7)
+        try:
+            title = json.loads(policy)["policy"]["name"]
+        except (ValueError, KeyError, TypeError):
+            title = "Fake policy"
+        section_size = self.document_size // len(POLICY_SECTIONS)
+        return f"---\ntitle: {json.dumps(title)}\n---\n\n" + "\n".join(
+            self.render_section(rng, title, section_size)
+            for title, _, _ in POLICY_SECTIONS
+        )
+
+    def stream(self, system, policy, usage=None):
+        stall = self.random.random() < self.stall_rate
+        time.sleep(self.stall_latency if stall else self.latency)
+        if self.random.random() < self.error_rate:
+            raise AIServiceError("Fake AI service unavailable", 503)
+        document = self.render(system, policy)
+        for start in range(0, len(document), self.chunk_size):
+            if start:
+                time.sleep(self.chunk_latency)
+            yield document[start : start + self.chunk_size]
+        if usage is not None:
+            usage["input_tokens"] = estimate_tokens(system, policy)
+            usage["output_tokens"] = len(document) // CHARACTERS_PER_TOKEN
+
+
+AI_SERVICES = {
+    "google": GoogleGenAI,
+    "fake": FakeGenAI,
+}
+
+
+def get_ai_service_class():
+    name = selected_ai_service or os.environ.get(
+        "POLGEN_AI_SERVICE", DEFAULT_AI_SERVICE
+    )
+    try:
+        return AI_SERVICES[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown AI service {name}, choose one of {', '.join(AI_SERVICES)}"
+        ) from None
 
 
 def get_ai_service():
-    # TODO: Read from config which genai service to use
     global ai_service
-    if ai_service is None:
-        ai_service = GoogleGenAI()
+    with ai_service_lock:
+        if ai_service is None:
+            ai_service = get_ai_service_class()()
     return ai_service
 
 
-def generate_markdown(system, policy):
+def get_ai_model():
+    return get_ai_service_class().model
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount, deadline=None):
+        # Wait until the amount is available. Returns whether the caller had to wait.
+        amount = min(amount, self.capacity)
+        waited = False
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                wait = (amount - self.tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise TimeoutError("Request deadline exceeded waiting for rate limit")
+            waited = True
+            time.sleep(wait)
+
+    def consume(self, amount):
+        # Account for usage that is only known after the request, may go into debt
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+
+
+def is_retryable(error):
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    # Network errors of the HTTP client used by the google genai library
+    httpx = sys.modules.get("httpx")
+    if isinstance(error, getattr(httpx, "TransportError", ())):
+        return True
+    return getattr(error, "code", None) in RETRYABLE_STATUS_CODES
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+# A single request to the AI service, of which there can be several for one call
+# when it is retried or hedged
+class RequestAttempt:
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.created = time.monotonic()
+        self.started = None
+        self.first_chunk = None
+        self.finished = None
+        self.chunks = 0
+        self.usage = {}
+        self.cancelled = threading.Event()
+
+
+def limit_stream(chunks, attempt):
+    for chunk in chunks:
+        if attempt.cancelled.is_set():
+            raise RequestCancelled("Request cancelled")
+        if attempt.deadline is not None and time.monotonic() > attempt.deadline:
+            raise TimeoutError("Request deadline exceeded while streaming")
+        if attempt.first_chunk is None:
+            attempt.first_chunk = time.monotonic()
+        attempt.chunks += 1
+        yield chunk
+
+
+def get_percentile(values, percentile):
+    ordered = sorted(values)
+    index = max(0, math.ceil(percentile / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+# Rate limits, retries, deadlines and hedging for the requests to the AI service
+class RequestScheduler:
+    def __init__(
+        self,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        max_retries=5,
+        timeout=None,
+        backoff=2.0,
+        max_backoff=60.0,
+        hedge_percentile=None,
+        hedge_min_delay=10.0,
+    ):
+        self.requests = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.lock = threading.Lock()
+        # Latencies of successful requests per kind, to derive the hedging thresholds
+        self.first_chunk_latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=HEDGE_MAX_SAMPLES)
+        )
+        self.durations = collections.defaultdict(
+            lambda: collections.deque(maxlen=HEDGE_MAX_SAMPLES)
+        )
+        self.stats = {
+            "successful": 0,
+            "throttled": 0,
+            "retried": 0,
+            "timed_out": 0,
+            "failed": 0,
+            "rate_limited": 0,
+            "hedged": 0,
+            "hedge_won": 0,
+        }
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def acquire(self, tokens, deadline):
+        waited = False
+        if self.requests is not None:
+            waited |= self.requests.acquire(1, deadline)
+        if self.tokens is not None:
+            waited |= self.tokens.acquire(tokens, deadline)
+        if waited:
+            self.count("rate_limited")
+
+    def get_backoff(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def call(
+        self, func, estimated_tokens=0, kind="request", discard=None, metrics=None
+    ):
+        # Call func(attempt) until it succeeds or fails with a non-retryable error.
+        # discard is called with the results of hedged requests that lost the race.
+        def measured(attempt):
+            result = func(attempt)
+            attempt.finished = time.monotonic()
+            return result, attempt
+
+        def discard_measured(measured_result):
+            discard(measured_result[0])
+
+        started = time.monotonic()
+        retries = 0
+        while True:
+            try:
+                if self.timeout or self.hedge_percentile:
+                    result, attempt = self.run_hedged(
+                        measured,
+                        estimated_tokens,
+                        kind,
+                        discard_measured if discard is not None else None,
+                    )
+                else:
+                    result, attempt = self.run(measured, estimated_tokens)
+            except Exception as e:
+                if isinstance(e, TimeoutError):
+                    self.count("timed_out")
+                elif getattr(e, "code", None) == 429:
+                    self.count("throttled")
+                if not is_retryable(e) or retries >= self.max_retries:
+                    self.count("failed")
+                    if metrics is not None:
+                        metrics.record_request(kind, started, retries=retries, error=e)
+                    raise
+                backoff = self.get_backoff(retries)
+                logger.warning(
+                    f"AI service request failed ({e}), retrying in {backoff:.1f}s"
+                )
+                self.count("retried")
+                retries += 1
+                time.sleep(backoff)
+                continue
+            self.count("successful")
+            if metrics is not None:
+                metrics.record_request(kind, started, attempt, retries)
+            return result
+
+    def run(self, func, estimated_tokens, attempt=None):
+        if attempt is None:
+            attempt = RequestAttempt(
+                time.monotonic() + self.timeout if self.timeout else None
+            )
+        try:
+            self.acquire(estimated_tokens, attempt.deadline)
+            attempt.started = time.monotonic()
+            return func(attempt)
+        finally:
+            self.account_usage(estimated_tokens, attempt.usage)
+
+    def start(self, func, estimated_tokens):
+        attempt = RequestAttempt(
+            time.monotonic() + self.timeout if self.timeout else None
+        )
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(self.run(func, estimated_tokens, attempt))
+            except BaseException as e:
+                future.set_exception(e)
+
+        # The request can not be interrupted while it waits for the AI service, so a
+        # request that exceeds its deadline is abandoned in its own thread
+        threading.Thread(target=run, daemon=True).start()
+        return attempt, future
+
+    def get_hedge_thresholds(self, kind):
+        with self.lock:
+            first_chunk_latencies = list(self.first_chunk_latencies[kind])
+            durations = list(self.durations[kind])
+        if not self.hedge_percentile or len(durations) < HEDGE_MIN_SAMPLES:
+            return None, None
+        return (
+            max(
+                self.hedge_min_delay,
+                get_percentile(first_chunk_latencies, self.hedge_percentile),
+            ),
+            max(self.hedge_min_delay, get_percentile(durations, self.hedge_percentile)),
+        )
+
+    def should_hedge(self, attempt, thresholds):
+        first_chunk_threshold, duration_threshold = thresholds
+        if attempt.started is None or duration_threshold is None:
+            return False
+        elapsed = time.monotonic() - attempt.started
+        if attempt.first_chunk is None and elapsed > first_chunk_threshold:
+            return True
+        return elapsed > duration_threshold
+
+    def load_latencies(self, metrics_report, model):
+        # Seeds the hedging thresholds with the latencies of a previous run of the
+        # same model, so the first requests of a run can be hedged as well
+        try:
+            with open(metrics_report) as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        except (OSError, json.JSONDecodeError):
+            return
+        with self.lock:
+            for record in records:
+                if record.get("model") != model:
+                    continue
+                for request in record.get("request_details", []):
+                    if request.get("error") or request.get("stream_time") is None:
+                        continue
+                    kind = request["kind"]
+                    if request.get("first_chunk") is not None:
+                        self.first_chunk_latencies[kind].append(request["first_chunk"])
+                    self.durations[kind].append(request["stream_time"])
+
+    def record_latency(self, kind, attempt):
+        with self.lock:
+            if attempt.first_chunk is not None:
+                self.first_chunk_latencies[kind].append(
+                    attempt.first_chunk - attempt.started
+                )
+            self.durations[kind].append(time.monotonic() - attempt.started)
+
+    def run_hedged(self, func, estimated_tokens, kind, discard):
+        # Run the request in the background with a hard deadline, and start a duplicate
+        # request if it is slower than most requests of the same kind. The thresholds
+        # are derived again on every poll, as concurrent requests finish.
+        primary, future = self.start(func, estimated_tokens)
+        running = {future: primary}
+        hedged = False
+        error = None
+        while running:
+            if hedged or not self.hedge_percentile:
+                deadlines = [a.deadline for a in running.values() if a.deadline]
+                timeout = (
+                    max(0, max(deadlines) - time.monotonic()) if deadlines else None
+                )
+            else:
+                timeout = HEDGE_POLL_INTERVAL
+            done, _ = concurrent.futures.wait(
+                running, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for finished in done:
+                attempt = running.pop(finished)
+                if finished.exception() is not None:
+                    error = finished.exception()
+                    continue
+                self.record_latency(kind, attempt)
+                if attempt is not primary:
+                    self.count("hedge_won")
+                self.abandon(running, discard)
+                return finished.result()
+
+            now = time.monotonic()
+            if running and all(
+                a.deadline is not None and now > a.deadline for a in running.values()
+            ):
+                self.abandon(running, discard)
+                raise TimeoutError("Request deadline exceeded")
+            if not hedged and primary in running.values():
+                if self.should_hedge(primary, self.get_hedge_thresholds(kind)):
+                    logger.info(f"Hedging slow {kind} request")
+                    self.count("hedged")
+                    hedged = True
+                    attempt, future = self.start(func, estimated_tokens)
+                    running[future] = attempt
+        raise error
+
+    def abandon(self, running, discard):
+        for future, attempt in running.items():
+            attempt.cancelled.set()
+            if discard is not None:
+                future.add_done_callback(
+                    lambda f: f.exception() is None and discard(f.result())
+                )
+
+    def account_usage(self, estimated_tokens, usage):
+        if self.tokens is not None and usage:
+            used_tokens = usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+            self.tokens.consume(used_tokens - estimated_tokens)
+
+
+def get_scheduler():
+    global scheduler
+    with ai_service_lock:
+        if scheduler is None:
+            scheduler = RequestScheduler()
+    return scheduler
+
+
+def estimate_tokens(system, policy):
+    return (len(system) + len(policy)) // CHARACTERS_PER_TOKEN
+
+
+def stream_markdown(system, policy, attempt):
     ai_client = get_ai_service()
-    return ai_client.generate(system, policy)
+    return limit_stream(ai_client.stream(system, policy, usage=attempt.usage), attempt)
+
+
+def generate_markdown(system, policy, kind="request", metrics=None):
+    return get_scheduler().call(
+        lambda attempt: "".join(stream_markdown(system, policy, attempt)),
+        estimated_tokens=estimate_tokens(system, policy),
+        kind=kind,
+        metrics=metrics,
+    )
 
 
-def main(base_ref):
+def write_generated_markdown(markdown_path, system, policy, metrics=None):
+    # Every request streams into its own temporary file, so a retried or hedged
+    # request starts from scratch and only the winner is moved into place
+    tmp_path = get_scheduler().call(
+        lambda attempt: write_temporary(
+            markdown_path, stream_markdown(system, policy, attempt)
+        ),
+        estimated_tokens=estimate_tokens(system, policy),
+        kind="policy",
+        discard=remove_temporary,
+        metrics=metrics,
+    )
+    replace_markdown(markdown_path, tmp_path)
+
+
+def get_markdown_path(policy_name):
+    markdown_path = os.path.join("wiki", "src", "content", "docs", policy_name)
+    root, ext = os.path.splitext(markdown_path)
+    if ext == ".json":
+        markdown_path = root + ".md"
+    return markdown_path
+
+
+def replace_markdown(markdown_path, tmp_path):
+    if os.path.exists(markdown_path):
+        logger.info("Resulting markdown file already exists")
+    os.replace(tmp_path, markdown_path)
+    logger.info(f"Updated markdown file {markdown_path}")
+
+
+def write_markdown(markdown_path, chunks):
+    replace_markdown(markdown_path, write_temporary(markdown_path, chunks))
+
+
+def get_seconds(start, end):
+    if start is None or end is None:
+        return None
+    return round(end - start, 3)
+
+
+# Timings and token usage of the generation of a single policy, for every request
+# it made to the AI service
+class PolicyMetrics:
+    def __init__(self, policy):
+        self.policy = policy
+        self.outcome = None
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.started = time.monotonic()
+
+    def finish(self, outcome=None):
+        self.finished = time.monotonic()
+        if outcome is not None:
+            self.outcome = outcome
+
+    def record_request(self, kind, started, attempt=None, retries=0, error=None):
+        request = {
+            "kind": kind,
+            "retries": retries,
+            "duration": get_seconds(started, time.monotonic()),
+        }
+        if attempt is not None:
+            request.update(
+                {
+                    "rate_limit_wait": get_seconds(attempt.created, attempt.started),
+                    "first_chunk": get_seconds(attempt.started, attempt.first_chunk),
+                    "stream_time": get_seconds(attempt.started, attempt.finished),
+                    "chunks": attempt.chunks,
+                    "input_tokens": attempt.usage.get("input_tokens"),
+                    "output_tokens": attempt.usage.get("output_tokens"),
+                }
+            )
+        if error is not None:
+            request["error"] = str(error)
+        with self.lock:
+            self.requests.append(request)
+
+    def to_dict(self):
+        with self.lock:
+            requests = list(self.requests)
+
+        def total(field):
+            return round(sum(request.get(field) or 0 for request in requests), 3)
+
+        first_chunks = [r["first_chunk"] for r in requests if r.get("first_chunk")]
+        return {
+            "policy": self.policy,
+            "outcome": self.outcome,
+            "queue_wait": get_seconds(self.submitted, self.started),
+            "duration": get_seconds(self.started, self.finished),
+            "requests": len(requests),
+            "retries": total("retries"),
+            "rate_limit_wait": total("rate_limit_wait"),
+            "first_chunk": min(first_chunks) if first_chunks else None,
+            "stream_time": total("stream_time"),
+            "chunks": total("chunks"),
+            "input_tokens": total("input_tokens"),
+            "output_tokens": total("output_tokens"),
+            "request_details": requests,
+        }
+
+
+class PolicyGenerator:
+    def __init__(
+        self,
+        system,
+        base_ref=None,
+        cache=None,
+        journal=None,
+        metadata_fast_path=True,
+        edit_mode=False,
+        parallel_sections=False,
+    ):
+        self.system = system
+        self.base_ref = base_ref
+        self.cache = cache
+        self.journal = journal
+        self.metadata_fast_path = metadata_fast_path
+        self.edit_mode = edit_mode
+        self.parallel_sections = parallel_sections
+
+    def load_base_policy(self, policy, markdown_path):
+        # The policy the existing markdown was generated from, which may be a version
+        # of the policy earlier in the same PR. It is looked up in the cache, then at
+        # the last commit of the markdown and at last in the base ref.
+        if not os.path.exists(markdown_path):
+            return None
+        if self.cache is not None:
+            source_json = self.cache.get_source(get_file_hash(markdown_path))
+            if source_json is not None:
+                return json.loads(source_json)
+
+        with open(markdown_path) as f:
+            markdown = f.read()
+        for ref in (get_last_commit(markdown_path), self.base_ref):
+            if ref is None or get_base_file(ref, markdown_path) != markdown:
+                continue
+            base_policy_json = get_base_file(ref, policy)
+            if base_policy_json is not None:
+                return json.loads(base_policy_json)
+        logger.info(f"Unknown from which policy {markdown_path} was generated")
+        return None
+
+    def update_metadata_header(self, policy, base_policy, new_policy, markdown_path):
+        changed_sections = get_changed_sections(base_policy, new_policy)
+        if not changed_sections:
+            logger.info(
+                f"Only the formatting of {policy} changed, keeping the markdown"
+            )
+            return True
+        if changed_sections != {"metadata"}:
+            return False
+
+        with open(markdown_path) as f:
+            markdown = f.read()
+        markdown = self.render_metadata_header(markdown, base_policy, new_policy)
+        if markdown is None:
+            logger.info(f"Unable to update the metadata header of {markdown_path}")
+            return False
+        logger.info(f"Only the metadata of {policy} changed, updating the header")
+        write_markdown(markdown_path, [markdown])
+        return True
+
+    def render_metadata_header(self, markdown, base_policy, new_policy):
+        base_metadata = base_policy.get("metadata", {})
+        metadata = new_policy.get("metadata", {})
+        if base_metadata == metadata:
+            return markdown
+        if not isinstance(base_metadata, dict) or not isinstance(metadata, dict):
+            return None
+        return render_metadata_header(markdown, base_metadata, metadata)
+
+    def edit(
+        self, policy, policy_json, base_policy, new_policy, markdown_path, metrics=None
+    ):
+        requirements_diff = get_requirements_diff(base_policy, new_policy)
+        if requirements_diff is None:
+            return False
+
+        with open(markdown_path) as f:
+            markdown = f.read()
+        # Metadata changes are applied locally, the model only edits the sections
+        markdown = self.render_metadata_header(markdown, base_policy, new_policy)
+        if markdown is None:
+            return False
+        logger.info(f"Only the requirements of {policy} changed, editing the markdown")
+        patch = generate_markdown(
+            self.system,
+            get_edit_request(markdown, policy_json, requirements_diff),
+            kind="edit",
+            metrics=metrics,
+        )
+        markdown = apply_section_patch(markdown, patch)
+        if markdown is None:
+            logger.warning(f"Unable to apply the edits to {markdown_path}")
+            return False
+        write_markdown(markdown_path, [markdown])
+        return True
+
+    def update_existing(self, policy, policy_json, markdown_path, metrics=None):
+        # Try to update the existing markdown instead of generating it from scratch.
+        # Returns how the markdown was updated, or None if it has to be generated.
+        if not self.metadata_fast_path and not self.edit_mode:
+            return None
+        base_policy = self.load_base_policy(policy, markdown_path)
+        if base_policy is None:
+            return None
+        new_policy = json.loads(policy_json)
+        if self.metadata_fast_path and self.update_metadata_header(
+            policy, base_policy, new_policy, markdown_path
+        ):
+            if get_changed_sections(base_policy, new_policy):
+                return "metadata"
+            return "unchanged"
+        if self.edit_mode and self.edit(
+            policy, policy_json, base_policy, new_policy, markdown_path, metrics
+        ):
+            return "edited"
+        return None
+
+    def generate_section(self, title, section_request, metrics=None):
+        key = get_section_key(self.system, title, section_request, get_ai_model())
+        cached_path = self.cache.get(key) if self.cache is not None else None
+        if cached_path is not None:
+            logger.debug(f"Reusing cached section {title}")
+            with open(cached_path) as f:
+                return f.read()
+        section = generate_markdown(
+            self.system, section_request, kind="section", metrics=metrics
+        )
+        if not section.endswith("\n"):
+            section += "\n"
+        if self.cache is not None:
+            self.cache.put(key, [section])
+        return section
+
+    def generate_sections(self, policy_json, metrics=None):
+        # Generate the independent sections concurrently and assemble them in order
+        policy = json.loads(policy_json)
+        sections = {}
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(POLICY_SECTIONS)
+        ) as executor:
+            for title, field_paths, derived_from in POLICY_SECTIONS:
+                if derived_from is None:
+                    section_request = get_section_request(
+                        title, select_policy_fields(policy, field_paths)
+                    )
+                    sections[title] = executor.submit(
+                        self.generate_section, title, section_request, metrics
+                    )
+            for title, field_paths, derived_from in POLICY_SECTIONS:
+                if derived_from is not None:
+                    section_request = get_section_request(
+                        title,
+                        select_policy_fields(policy, field_paths),
+                        derived_from,
+                        sections[derived_from].result(),
+                    )
+                    sections[title] = executor.submit(
+                        self.generate_section, title, section_request, metrics
+                    )
+            yield render_policy_header(policy)
+            for index, (title, _, _) in enumerate(POLICY_SECTIONS):
+                if index:
+                    yield "\n"
+                yield sections[title].result()
+
+    def generate(self, policy, metrics=None):
+        # Returns whether the markdown of the policy changed
+        markdown_path = get_markdown_path(policy)
+        previous_hash = get_file_hash(markdown_path)
+        if metrics is not None:
+            metrics.start()
+        try:
+            outcome = self.generate_policy(policy, metrics)
+        except Exception:
+            if metrics is not None:
+                metrics.finish("failed")
+            raise
+        if metrics is not None:
+            metrics.finish(outcome)
+        return get_file_hash(markdown_path) != previous_hash
+
+    def generate_policy(self, policy, metrics=None):
+        # Returns how the markdown of the policy was produced
+        policy_json = read_policy(policy)
+        markdown_path = get_markdown_path(policy)
+        key = get_generation_key(self.system, policy_json, get_ai_model())
+        if self.journal is not None and self.journal.is_completed(
+            policy, key, markdown_path
+        ):
+            logger.info(
+                f"Skipping {policy}, it was already generated by the resumed run"
+            )
+            return "resumed"
+
+        cached_path = self.cache.get(key) if self.cache is not None else None
+        if cached_path is not None:
+            logger.info(f"Reusing cached markdown for {policy}")
+            write_markdown(markdown_path, read_chunks(cached_path))
+            outcome = "cached"
+        else:
+            outcome = self.update_existing(policy, policy_json, markdown_path, metrics)
+        if outcome is None:
+            if self.parallel_sections:
+                write_markdown(
+                    markdown_path, self.generate_sections(policy_json, metrics)
+                )
+            else:
+                write_generated_markdown(
+                    markdown_path, self.system, policy_json, metrics
+                )
+            if self.cache is not None:
+                self.cache.put(key, read_chunks(markdown_path))
+            outcome = "generated"
+
+        if self.cache is not None:
+            self.cache.put_source(get_file_hash(markdown_path), policy_json)
+        if self.journal is not None:
+            self.journal.record(policy, key, markdown_path)
+        return outcome
+
+
+def write_metrics_report(path, policy_metrics):
+    model = get_ai_model()
+    write_atomic(
+        path,
+        (
+            json.dumps({"model": model, **metrics.to_dict()}) + "\n"
+            for metrics in policy_metrics
+        ),
+    )
+
+
+def format_seconds(seconds):
+    return "-" if seconds is None else f"{seconds:.1f}s"
+
+
+def write_step_summary(path, policy_metrics, stats):
+    # Appends a markdown summary of the run, e.g. to $GITHUB_STEP_SUMMARY
+    records = [metrics.to_dict() for metrics in policy_metrics]
+    requests = [request for record in records for request in record["request_details"]]
+    lines = [
+        "## Policy generation",
+        "",
+        f"Model: `{get_ai_model()}`",
+        "",
+        f"{len(records)} policies, {len(requests)} requests, "
+        f"{sum(r['input_tokens'] for r in records)} input tokens, "
+        f"{sum(r['output_tokens'] for r in records)} output tokens, "
+        + ", ".join(f"{value} {stat}" for stat, value in stats.items()),
+        "",
+    ]
+    for field, title in (("first_chunk", "First chunk"), ("stream_time", "Stream")):
+        values = [request[field] for request in requests if request.get(field)]
+        if values:
+            lines.append(
+                f"{title}: p50 {format_seconds(get_percentile(values, 50))}, "
+                f"p95 {format_seconds(get_percentile(values, 95))}"
+            )
+    lines += [
+        "",
+        "| Policy | Outcome | Queue | Duration | Requests | Retries "
+        "| First chunk | Stream | Input tokens | Output tokens |",
+        "| --- | --- | ---: | ---: | ---: | ---: | ---: | ---: | ---: | ---: |",
+    ]
+    for record in records:
+        lines.append(
+            f"| {record['policy']} | {record['outcome']} "
+            f"| {format_seconds(record['queue_wait'])} "
+            f"| {format_seconds(record['duration'])} "
+            f"| {record['requests']} | {record['retries']} "
+            f"| {format_seconds(record['first_chunk'])} "
+            f"| {format_seconds(record['stream_time'] or None)} "
+            f"| {record['input_tokens']} | {record['output_tokens']} |"
+        )
+    with open(path, "a") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def main(
+    base_ref,
+    workers=1,
+    cache_dir=DEFAULT_CACHE_DIR,
+    journal_path=DEFAULT_JOURNAL_PATH,
+    resume=False,
+    metadata_fast_path=True,
+    edit_mode=False,
+    parallel_sections=False,
+    request_scheduler=None,
+    ai_service_name=None,
+    metrics_report=None,
+    step_summary=None,
+):
+    global scheduler, selected_ai_service
+    if request_scheduler is not None:
+        scheduler = request_scheduler
+    if ai_service_name is not None:
+        selected_ai_service = ai_service_name
+    if metrics_report:
+        # The report of the previous run is restored with the cache
+        get_scheduler().load_latencies(metrics_report, get_ai_model())
+
     changed_or_added_files = get_changed_files(base_ref)
     policies = filter_policies(changed_or_added_files)
 
     system = get_system_prompt()
+    cache = GenerationCache(cache_dir) if cache_dir else None
+
+    failed_policies = []
+    with (
+        GenerationJournal(journal_path, resume=resume) as journal,
+        concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor,
+    ):
+        generator = PolicyGenerator(
+            system,
+            base_ref=base_ref,
+            cache=cache,
+            journal=journal,
+            metadata_fast_path=metadata_fast_path,
+            edit_mode=edit_mode,
+            parallel_sections=parallel_sections,
+        )
+        policy_metrics = {policy: PolicyMetrics(policy) for policy in policies}
+        futures = {
+            policy: executor.submit(generator.generate, policy, policy_metrics[policy])
+            for policy in policies
+        }
+        # Results are reported in the order of the changed files, regardless of the
+        # order in which the generations finish. Only policies of which the markdown
+        # changed are printed, so there is nothing to commit when none are.
+        for policy in policies:
+            try:
+                changed = futures[policy].result()
+            except Exception:
+                logger.exception(f"Failed to generate markdown for {policy}")
+                failed_policies.append(policy)
+                continue
+            if changed:
+                print(policy)
+            else:
+                logger.info(f"The markdown of {policy} is unchanged")
 
-    policies_markdown = {}
+    # Requests that exceeded their deadline or lost a hedge race may still be writing
     for policy in policies:
-        # TODO: Check if the resulting policy already exists and if so, use it in the system query
-        md = generate_markdown(system, policy)
-        policies_markdown[policy] = md
-
-    for policy_name, markdown in policies_markdown.items():
-        markdown_path = os.path.join("wiki", "src", "content", "docs", policy_name)
-        root, ext = os.path.splitext(markdown_path)
-        if ext == ".json":
-            markdown_path = root + ".md"
-        if os.path.exists(markdown_path):
-            logger.info("Resulting markdown file already exists")
-        else:
-            os.makedirs(os.path.dirname(markdown_path), exist_ok=True)
-        with open(markdown_path, "w+") as f:
-            f.write(markdown)
-        logger.info(f"Updated markdown file {markdown_path}")
-        print(policy_name)
+        remove_abandoned_temporaries(get_markdown_path(policy))
+
+    stats = get_scheduler().stats
+    logger.info(
+        "AI service requests: "
+        + ", ".join(f"{stat} {value}" for stat, value in stats.items())
+    )
+    if metrics_report:
+        write_metrics_report(metrics_report, policy_metrics.values())
+    if step_summary:
+        write_step_summary(step_summary, policy_metrics.values(), stats)
+    return failed_policies
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--base-ref", required=True)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of policies that are generated concurrently",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        help="Directory of previously generated markdown, keyed on the generation inputs",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache_dir",
+        action="store_const",
+        const="",
+        help="Always generate the markdown, even when the inputs did not change",
+    )
+    parser.add_argument(
+        "--journal",
+        default=DEFAULT_JOURNAL_PATH,
+        help="File in which every finished policy of the run is recorded",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Only generate the policies the journal does not record as finished",
+    )
+    parser.add_argument(
+        "--no-metadata-fast-path",
+        dest="metadata_fast_path",
+        action="store_false",
+        help="Regenerate policies with the AI service even if only their metadata changed",
+    )
+    parser.add_argument(
+        "--edit-mode",
+        action="store_true",
+        help="Let the AI service only rewrite the sections affected by changed requirements",
+    )
+    parser.add_argument(
+        "--parallel-sections",
+        action="store_true",
+        help="Generate the sections of a policy concurrently and cache them separately",
+    )
+    parser.add_argument(
+        "--requests-per-minute",
+        type=int,
+        help="Maximum number of requests per minute to the AI service",
+    )
+    parser.add_argument(
+        "--tokens-per-minute",
+        type=int,
+        help="Maximum number of input and output tokens per minute of the AI service",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=5,
+        help="Number of retries of a request that failed with a retryable error",
+    )
+    parser.add_argument(
+        "--request-timeout",
+        type=float,
+        help="Deadline in seconds of a single request to the AI service",
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        help="Start a duplicate request when a request has not produced its first chunk "
+        "or has not finished within this percentile of the previous requests",
+    )
+    parser.add_argument(
+        "--hedge-min-delay",
+        type=float,
+        default=10.0,
+        help="Minimum number of seconds before a request is hedged",
+    )
+    parser.add_argument(
+        "--ai-service",
+        choices=sorted(AI_SERVICES),
+        default=os.environ.get("POLGEN_AI_SERVICE", DEFAULT_AI_SERVICE),
+        help="AI service that generates the policies, fake runs offline",
+    )
+    parser.add_argument(
+        "--metrics-report",
+        help="JSON lines file in which the timings and token usage of every policy "
+        "are written",
+    )
+    parser.add_argument(
+        "--step-summary",
+        default=os.environ.get("GITHUB_STEP_SUMMARY"),
+        help="Markdown file to which a summary of the run is appended, "
+        "defaults to $GITHUB_STEP_SUMMARY",
+    )
     args = parser.parse_args()
 
-    main(args.base_ref)
+    failed_policies = main(
+        args.base_ref,
+        workers=args.workers,
+        cache_dir=args.cache_dir,
+        journal_path=args.journal,
+        resume=args.resume,
+        metadata_fast_path=args.metadata_fast_path,
+        edit_mode=args.edit_mode,
+        parallel_sections=args.parallel_sections,
+        request_scheduler=RequestScheduler(
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+            max_retries=args.max_retries,
+            timeout=args.request_timeout,
+            hedge_percentile=args.hedge_percentile,
+            hedge_min_delay=args.hedge_min_delay,
+        ),
+        ai_service_name=args.ai_service,
+        metrics_report=args.metrics_report,
+        step_summary=args.step_summary,
+    )
+    if failed_policies:
+        logger.error(
+            f"Failed to generate {len(failed_policies)} policies: {', '.join(failed_policies)}"
+        )
+        sys.exit(1)
@@ -5,15 +5,19 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import argparse
+import concurrent.futures
 import contextlib
+import datetime
 import hashlib
 import json
 import logging
+import os
 import platform
 import re
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 from typing import Any
 
@@ -25,6 +29,18 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_AWS_BACKEND = "aws"
+DEFAULT_WORKERS = 8
+CAMEL_CASE_PATTERN = re.compile(r"(?<!^)(?=[A-Z])")
+# Stack events are polled fast at first and slower the longer a stack operation takes
+STACK_WAIT_MIN_DELAY = 2
+STACK_WAIT_MAX_DELAY = 30
+STACK_WAIT_BACKOFF = 1.5
+STACK_WAIT_TIMEOUT = 3600
+AWS_CLI_ERROR_PATTERN = re.compile(
+    r"^An error occurred \((.+)\) when calling the \w+ operation: (.*)$"
+)
+
 
 CLOUDFORMATION_INIT_TEMPLATE = """{
   "AWSTemplateFormatVersion": "2010-09-09",
@@ -136,24 +152,6 @@ def get_postfix(unique_seed: str) -> str:
     return hashlib.sha256(unique_seed.encode("utf-8")).hexdigest()[:16]
 
 
-def is_boto3_available() -> bool:
-    return boto3 is not None
-
-
-def is_aws_cli_available() -> bool:
-    try:
-        result = subprocess.run(
-            [os_cmd("aws"), "--version"], check=True, capture_output=True, text=True
-        )
-    except subprocess.CalledProcessError:
-        return False
-    return result.stdout.strip().startswith("aws-cli")
-
-
-def is_aws_interface_available() -> bool:
-    return is_boto3_available() or is_aws_cli_available()
-
-
 def cli_encode_arg_value(value: Any) -> str:
     if isinstance(value, str):
         return value
@@ -189,51 +187,278 @@ class AWSCommandError(Exception):
         self.detail = detail
 
 
-def aws_command(service: str, cmd: str, kwargs: dict[str, Any]) -> dict[str, Any]:
-    if is_boto3_available():
-        client = boto3.client(service)
-        try:
-            return getattr(client, cmd)(**kwargs)
-        except botocore.exceptions.ClientError as e:
-            message = f"An error occurred ({e.response['Error']['Code']}) when calling the {e.operation_name} operation: {e.response['Error']['Message']}"
-            raise AWSCommandError(
-                message, e.response["Error"]["Code"], e.response["Error"]["Message"]
-            ) from e
-    else:
-        pattern = re.compile(r"(?<!^)(?=[A-Z])")
+def get_client_error(e: "botocore.exceptions.ClientError") -> AWSCommandError:
+    code = e.response["Error"]["Code"]
+    detail = e.response["Error"]["Message"]
+    message = f"An error occurred ({code}) when calling the {e.operation_name} operation: {detail}"
+    return AWSCommandError(message, code, detail)
+
 
+def get_cli_error(e: subprocess.CalledProcessError) -> AWSCommandError:
+    error_message = e.stderr.strip()
+    error_match = AWS_CLI_ERROR_PATTERN.match(error_message)
+    if e.returncode == 254 and error_match:
+        return AWSCommandError(
+            error_message, error_match.group(1), error_match.group(2)
+        )
+    return AWSCommandError(error_message or str(e))
+
+
+class AWSSession:
+    """
+    Access to AWS through boto3, or through the AWS CLI if boto3 is not installed.
+    Clients and capability probes are created once and shared between threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._boto3_session = None
+        self._clients = {}
+        self._cli_available = None
+        self._region = None
+
+    def is_boto3_available(self) -> bool:
+        return boto3 is not None
+
+    def is_cli_available(self) -> bool:
+        with self._lock:
+            if self._cli_available is None:
+                try:
+                    result = subprocess.run(
+                        [os_cmd("aws"), "--version"],
+                        check=True,
+                        capture_output=True,
+                        text=True,
+                    )
+                    self._cli_available = result.stdout.strip().startswith("aws-cli")
+                except (OSError, subprocess.CalledProcessError):
+                    self._cli_available = False
+            return self._cli_available
+
+    def is_available(self) -> bool:
+        return self.is_boto3_available() or self.is_cli_available()
+
+    def client(self, service: str):
+        # A boto3 session is not thread safe, its clients are
+        with self._lock:
+            if service not in self._clients:
+                if self._boto3_session is None:
+                    self._boto3_session = boto3.session.Session()
+                self._clients[service] = self._boto3_session.client(service)
+            return self._clients[service]
+
+    def command(self, service: str, cmd: str, kwargs: dict[str, Any]) -> dict[str, Any]:
+        if self.is_boto3_available():
+            try:
+                return getattr(self.client(service), cmd)(**kwargs)
+            except botocore.exceptions.ClientError as e:
+                raise get_client_error(e) from e
+            except botocore.exceptions.BotoCoreError as e:
+                raise AWSCommandError(str(e)) from e
+
+        kwargs = dict(kwargs)
         with process_special_aws_kwargs(kwargs) as args:
             args += [
-                f"--{pattern.sub("-", arg).lower()}={cli_encode_arg_value(value)}"
+                f"--{CAMEL_CASE_PATTERN.sub('-', arg).lower()}={cli_encode_arg_value(value)}"
                 for arg, value in kwargs.items()
             ]
-            cmd = cmd.replace("_", "-")
             try:
                 result = subprocess.run(
-                    [os_cmd("aws"), service, cmd, *args, "--output=json"],
+                    [
+                        os_cmd("aws"),
+                        service,
+                        cmd.replace("_", "-"),
+                        *args,
+                        "--output=json",
+                        # Like boto3, return a single page with its NextToken instead
+                        # of fetching all pages
+                        "--no-paginate",
+                    ],
                     check=True,
                     capture_output=True,
                     text=True,
                 )
             except subprocess.CalledProcessError as e:
-                error_message = e.stderr.strip()
-                if e.returncode == 254 and error_message.startswith(
-                    "An error occurred"
-                ):
-                    error_match = re.match(
-                        r"^An error occurred \((.+)\) when calling the \w+ operation: (.*)$",
-                        error_message,
-                    )
-                    if error_match:
-                        raise AWSCommandError(
-                            error_message, error_match.group(1), error_match.group(2)
-                        ) from e
-                raise
+                raise get_cli_error(e) from e
         return json.loads(result.stdout.strip())
 
+    def get_region(self) -> str:
+        with self._lock:
+            if self._region is None:
+                if self.is_boto3_available():
+                    if self._boto3_session is None:
+                        self._boto3_session = boto3.session.Session()
+                    self._region = self._boto3_session.region_name
+                else:
+                    result = subprocess.run(
+                        [os_cmd("aws"), "configure", "get", "region"],
+                        check=True,
+                        capture_output=True,
+                        text=True,
+                    )
+                    self._region = result.stdout.strip()
+            return self._region
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+
+class FakeAWSSession(AWSSession):
+    """
+    In-process stand-in for AWS, without network access or credentials. CloudFormation
+    stacks are created and updated immediately, their outputs are derived from the
+    names in the template.
+    """
+
+    EVENTS_PAGE_SIZE = 4
+
+    def __init__(self, region: str = "us-east-1", account_id: str = "123456789012"):
+        super().__init__()
+        self._region = region
+        self.account_id = account_id
+        self.stacks = {}
+        self.events = {}
+        self.calls = []
+
+    def is_boto3_available(self) -> bool:
+        return False
+
+    def is_cli_available(self) -> bool:
+        return True
+
+    def command(self, service: str, cmd: str, kwargs: dict[str, Any]) -> dict[str, Any]:
+        with self._lock:
+            self.calls.append((service, cmd, kwargs))
+            handler = getattr(self, f"{service}_{cmd}", None)
+            if handler is None:
+                raise AWSCommandError(
+                    f"An error occurred (InvalidAction) when calling the {cmd} operation",
+                    "InvalidAction",
+                    f"{service} {cmd} is not supported by the fake AWS session",
+                )
+            return handler(**kwargs)
+
+    def sleep(self, seconds: float):
+        pass
+
+    def get_stack(self, stack_name: str, operation: str) -> dict[str, Any]:
+        for stack in self.stacks.values():
+            if stack_name in (stack["StackName"], stack["StackId"]):
+                return stack
+        detail = f"Stack with id {stack_name} does not exist"
+        raise AWSCommandError(
+            f"An error occurred (ValidationError) when calling the {operation} operation: {detail}",
+            "ValidationError",
+            detail,
+        )
+
+    def sts_get_caller_identity(self) -> dict[str, Any]:
+        return {"Account": self.account_id}
+
+    def cloudformation_describe_stacks(self, StackName: str) -> dict[str, Any]:
+        return {"Stacks": [self.get_stack(StackName, "DescribeStacks")]}
+
+    def cloudformation_create_stack(
+        self, StackName: str, TemplateBody: str, **kwargs
+    ) -> dict[str, Any]:
+        stack_id = (
+            f"arn:aws:cloudformation:{self._region}:{self.account_id}:"
+            f"stack/{StackName}/{len(self.stacks)}"
+        )
+        template = json.loads(TemplateBody)
+        stack = {
+            "StackId": stack_id,
+            "StackName": StackName,
+            "StackStatus": "CREATE_COMPLETE",
+            "CreationTime": datetime.datetime.now(datetime.timezone.utc),
+            "TemplateBody": TemplateBody,
+            "Outputs": [
+                {"OutputKey": key, "OutputValue": f"{StackName}-{key}"}
+                for key in template.get("Outputs", {})
+            ],
+        }
+        self.stacks[stack_id] = stack
+        self.events[stack_id] = []
+        self.add_stack_event(stack, "CREATE_IN_PROGRESS")
+        for logical_id, resource in template.get("Resources", {}).items():
+            for status in ["CREATE_IN_PROGRESS", "CREATE_COMPLETE"]:
+                self.add_stack_event(stack, status, logical_id, resource["Type"])
+        self.add_stack_event(stack, "CREATE_COMPLETE")
+        return {"StackId": stack_id}
+
+    def cloudformation_update_stack(
+        self, StackName: str, TemplateBody: str, **kwargs
+    ) -> dict[str, Any]:
+        stack = self.get_stack(StackName, "UpdateStack")
+        if stack["TemplateBody"] == TemplateBody:
+            detail = "No updates are to be performed."
+            raise AWSCommandError(
+                f"An error occurred (ValidationError) when calling the UpdateStack operation: {detail}",
+                "ValidationError",
+                detail,
+            )
+        stack["TemplateBody"] = TemplateBody
+        stack["StackStatus"] = "UPDATE_COMPLETE"
+        stack["LastUpdatedTime"] = datetime.datetime.now(datetime.timezone.utc)
+        for status in [
+            "UPDATE_IN_PROGRESS",
+            "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS",
+            "UPDATE_COMPLETE",
+        ]:
+            self.add_stack_event(stack, status)
+        return {"StackId": stack["StackId"]}
+
+    def cloudformation_describe_stack_events(
+        self, StackName: str, NextToken: str = "0"
+    ) -> dict[str, Any]:
+        stack = self.get_stack(StackName, "DescribeStackEvents")
+        start = int(NextToken)
+        events = self.events[stack["StackId"]][::-1]
+        result = {"StackEvents": events[start : start + self.EVENTS_PAGE_SIZE]}
+        if start + self.EVENTS_PAGE_SIZE < len(events):
+            result["NextToken"] = str(start + self.EVENTS_PAGE_SIZE)
+        return result
+
+    def add_stack_event(
+        self,
+        stack: dict[str, Any],
+        status: str,
+        logical_id: str = "",
+        resource_type: str = "AWS::CloudFormation::Stack",
+    ):
+        events = self.events[stack["StackId"]]
+        events.append(
+            {
+                "EventId": f"{stack['StackName']}-{len(events)}",
+                "StackId": stack["StackId"],
+                "LogicalResourceId": logical_id or stack["StackName"],
+                "PhysicalResourceId": (
+                    stack["StackId"] if not logical_id else f"{logical_id}-physical"
+                ),
+                "ResourceType": resource_type,
+                "ResourceStatus": status,
+                "Timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            }
+        )
+
 
-def get_aws_account_id() -> str:
-    result = aws_command("sts", "get_caller_identity", {})
+AWS_SESSIONS = {
+    "aws": AWSSession,
+    "fake": FakeAWSSession,
+}
+
+
+def get_aws_session() -> AWSSession:
+    backend = os.environ.get("POLGEN_AWS_BACKEND", DEFAULT_AWS_BACKEND)
+    if backend not in AWS_SESSIONS:
+        raise ValueError(
+            f"Unknown AWS backend {backend}, choose from {', '.join(AWS_SESSIONS)}"
+        )
+    return AWS_SESSIONS[backend]()
+
+
+def get_aws_account_id(session: AWSSession) -> str:
+    result = session.command("sts", "get_caller_identity", {})
     return result["Account"]
 
 
@@ -241,12 +466,12 @@ def get_bootstrap_stack_name(postfix: str) -> str:
     return f"PolGenBootstrap{postfix}"
 
 
-def get_bootstrap_stack(postfix: str):
+def get_bootstrap_stack(session: AWSSession, postfix: str):
     kwargs = {
         "StackName": get_bootstrap_stack_name(postfix),
     }
     try:
-        result = aws_command("cloudformation", "describe_stacks", kwargs)
+        result = session.command("cloudformation", "describe_stacks", kwargs)
     except AWSCommandError as e:
         if e.code == "ValidationError":
             return None  # A ValidationError means no stack exists with that name
@@ -258,7 +483,84 @@ def get_bootstrap_stack(postfix: str):
     return None
 
 
-def create_bootstrap_stack(postfix: str, wait_until_created=True):
+def get_new_stack_events(
+    session: AWSSession, stack_id: str, last_event_id: str | None = None
+) -> list[dict[str, Any]]:
+    # Events are returned from new to old, so pages are only requested until the last
+    # event that was already seen
+    events = []
+    kwargs = {"StackName": stack_id}
+    while True:
+        result = session.command("cloudformation", "describe_stack_events", kwargs)
+        for event in result.get("StackEvents", []):
+            if event["EventId"] == last_event_id:
+                return events[::-1]
+            events.append(event)
+        if not result.get("NextToken"):
+            return events[::-1]
+        kwargs = {"StackName": stack_id, "NextToken": result["NextToken"]}
+
+
+def get_last_stack_event_id(session: AWSSession, stack_id: str) -> str | None:
+    result = session.command(
+        "cloudformation", "describe_stack_events", {"StackName": stack_id}
+    )
+    events = result.get("StackEvents", [])
+    return events[0]["EventId"] if events else None
+
+
+def wait_for_stack(
+    session: AWSSession,
+    stack_id: str,
+    complete_status: str,
+    last_event_id: str | None = None,
+    resource_count: int = 0,
+    timeout: float = STACK_WAIT_TIMEOUT,
+    report=print,
+):
+    delay = STACK_WAIT_MIN_DELAY
+    waited = 0
+    completed_resources = set()
+    while True:
+        stack_status = None
+        for event in get_new_stack_events(session, stack_id, last_event_id):
+            last_event_id = event["EventId"]
+            status = event["ResourceStatus"]
+            reason = event.get("ResourceStatusReason")
+            reason = f": {reason}" if reason else ""
+            if (
+                event["ResourceType"] == "AWS::CloudFormation::Stack"
+                and event["PhysicalResourceId"] == stack_id
+            ):
+                stack_status = status
+                report(f"Stack {status}{reason}")
+                continue
+            if status.endswith("_COMPLETE"):
+                completed_resources.add(event["LogicalResourceId"])
+            progress = (
+                f"[{len(completed_resources)}/{resource_count}] "
+                if resource_count
+                else ""
+            )
+            report(
+                f"{progress}{event['LogicalResourceId']} ({event['ResourceType']}) {status}{reason}"
+            )
+
+        if stack_status and not stack_status.endswith("_IN_PROGRESS"):
+            if stack_status != complete_status:
+                raise Exception(f"Stack {stack_id} failed in state {stack_status}")
+            return
+        if waited >= timeout:
+            raise Exception(f"Timed out waiting for stack {stack_id}")
+        logger.debug("Check stack events in %.1fs", delay)
+        session.sleep(delay)
+        waited += delay
+        delay = min(delay * STACK_WAIT_BACKOFF, STACK_WAIT_MAX_DELAY)
+
+
+def create_bootstrap_stack(
+    session: AWSSession, postfix: str, wait_until_created=True, report=print
+):
     kwargs = {
         "StackName": get_bootstrap_stack_name(postfix),
         "TemplateBody": CLOUDFORMATION_INIT_TEMPLATE
@@ -267,26 +569,23 @@ def create_bootstrap_stack(postfix: str, wait_until_created=True):
         },
         "Capabilities": ["CAPABILITY_IAM"],
     }
-    result = aws_command("cloudformation", "create_stack", kwargs)
+    result = session.command("cloudformation", "create_stack", kwargs)
     if wait_until_created:
-        if is_boto3_available():
-            waiter = boto3.client("cloudformation").get_waiter("stack_create_complete")
-            waiter.wait(StackName=result["StackId"])
-        else:
-            for i in range(120):
-                time.sleep(30)
-                logger.debug("Check stack creation")
-                stack = get_bootstrap_stack(postfix)
-                if stack["StackStatus"] == "CREATE_COMPLETE":
-                    break
-                if stack["StackStatus"] != "CREATE_IN_PROGRESS":
-                    raise Exception(
-                        f"Stack {stack['StackId']} creation failed in state {stack['StackStatus']}"
-                    )
+        wait_for_stack(
+            session,
+            result["StackId"],
+            "CREATE_COMPLETE",
+            resource_count=len(json.loads(kwargs["TemplateBody"])["Resources"]),
+            report=report,
+        )
 
 
 def update_bootstrap_stack(
-    postfix: str, stack: dict[str, Any], wait_until_updated=True
+    session: AWSSession,
+    postfix: str,
+    stack: dict[str, Any],
+    wait_until_updated=True,
+    report=print,
 ):
     kwargs = {
         "StackName": stack["StackId"],
@@ -297,34 +596,24 @@ def update_bootstrap_stack(
         "Capabilities": ["CAPABILITY_IAM"],
     }
     result = None
+    last_event_id = get_last_stack_event_id(session, stack["StackId"])
     try:
-        result = aws_command("cloudformation", "update_stack", kwargs)
+        result = session.command("cloudformation", "update_stack", kwargs)
     except AWSCommandError as e:
         if e.code != "ValidationError" or not e.detail.startswith(
             "No updates are to be performed"
         ):
             raise
-        print("Stack is up to date")
+        report("Stack is up to date")
 
     if result and wait_until_updated:
-        if is_boto3_available():
-            waiter = boto3.client("cloudformation").get_waiter("stack_update_complete")
-            waiter.wait(StackName=result["StackId"])
-        else:
-            for i in range(120):
-                time.sleep(30)
-                logger.debug("Check stack update")
-                stack = get_bootstrap_stack(postfix)
-                if stack["StackStatus"] == "UPDATE_COMPLETE":
-                    break
-                if stack["StackStatus"] not in {
-                    "UPDATE_IN_PROGRESS",
-                    "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS",
-                }:
-                    logger.debug(
-                        f"Stack {stack['StackId']} update failed in state {stack['StackStatus']}"
-                    )
-                    raise Exception(f"Stack {stack['StackId']} update failed")
+        wait_for_stack(
+            session,
+            result["StackId"],
+            "UPDATE_COMPLETE",
+            last_event_id=last_event_id,
+            report=report,
+        )
 
 
 def get_stack_output(stack: dict[str, Any], name: str) -> str:
@@ -334,17 +623,133 @@ def get_stack_output(stack: dict[str, Any], name: str) -> str:
     raise KeyError(f"Key {name} not found in Outputs")
 
 
-def get_aws_region() -> str:
-    if is_boto3_available():
-        return boto3.session.Session().region_name
-    else:
-        result = subprocess.run(
-            ["aws", "configure", "get", "region"],
-            check=True,
-            capture_output=True,
-            text=True,
+def get_seeds(args) -> list[str]:
+    # Unique seeds in the format "<user/company name>/<repo name>/<branch>"
+    seeds = list(args.seed or [])
+    if args.seeds_file:
+        with open(args.seeds_file) as f:
+            seeds += [
+                line.strip()
+                for line in f
+                if line.strip() and not line.strip().startswith("#")
+            ]
+    for seed in seeds:
+        if len(seed.split("/", 2)) != 3 or not all(seed.split("/", 2)):
+            print(
+                f'Not a valid seed "{seed}", expected "<user/company name>/<repo name>/<branch>"'
+            )
+            sys.exit(1)
+    if not seeds:
+        print("No seeds given, use --seed or --seeds-file")
+        sys.exit(1)
+    return list(dict.fromkeys(seeds))
+
+
+def run_for_seeds(func, seeds: list[str], workers: int) -> dict[str, Any]:
+    # The result of func for every seed, or the exception it raised
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {seed: executor.submit(func, seed) for seed in seeds}
+    results = {}
+    for seed, future in futures.items():
+        try:
+            results[seed] = future.result()
+        except Exception as e:
+            logger.debug("Failed for seed %s", seed, exc_info=True)
+            results[seed] = e
+    return results
+
+
+def format_stack_time(value: Any) -> str:
+    # boto3 returns datetimes, the AWS CLI ISO strings
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(timespec="seconds")
+    return str(value or "")[:19]
+
+
+def print_stack_table(results: dict[str, Any]):
+    # Stack states and outputs, without the secret access key
+    rows = [["Seed", "Stack", "Status", "Updated", "Bucket", "Access key ID"]]
+    for seed, stack in results.items():
+        stack_name = get_bootstrap_stack_name(get_postfix(seed))
+        if isinstance(stack, Exception):
+            rows.append([seed, stack_name, f"ERROR: {stack}", "", "", ""])
+        elif stack is None:
+            rows.append([seed, stack_name, "MISSING", "", "", ""])
+        else:
+            outputs = {
+                output["OutputKey"]: output["OutputValue"]
+                for output in stack.get("Outputs", [])
+            }
+            rows.append(
+                [
+                    seed,
+                    stack_name,
+                    stack["StackStatus"],
+                    format_stack_time(
+                        stack.get("LastUpdatedTime") or stack.get("CreationTime")
+                    ),
+                    outputs.get("BucketName", ""),
+                    outputs.get("AccessKeyID", ""),
+                ]
+            )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print(
+            "  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
         )
-        return result.stdout.strip()
+
+
+def status(args):
+    seeds = get_seeds(args)
+    session = get_aws_session()
+    if not session.is_available():
+        print("Neither Boto3 nor the AWS CLI is available.")
+        sys.exit(1)
+
+    results = run_for_seeds(
+        lambda seed: get_bootstrap_stack(session, get_postfix(seed)),
+        seeds,
+        args.workers,
+    )
+    print_stack_table(results)
+    if any(isinstance(result, Exception) for result in results.values()):
+        sys.exit(1)
+
+
+def init_batch(args):
+    # Creates or updates the bootstrap stacks of all seeds without asking
+    seeds = get_seeds(args)
+    session = get_aws_session()
+    if not session.is_available():
+        print("Neither Boto3 nor the AWS CLI is available.")
+        sys.exit(1)
+    # Workers report concurrently, print() writes the message and newline separately
+    report_lock = threading.Lock()
+
+    def bootstrap(seed: str):
+        postfix = get_postfix(seed)
+
+        def report(message: str):
+            with report_lock:
+                sys.stdout.write(f"[{seed}] {message}\n")
+                sys.stdout.flush()
+
+        stack = get_bootstrap_stack(session, postfix)
+        if stack:
+            report("Updating stack...")
+            update_bootstrap_stack(session, postfix, stack, report=report)
+        else:
+            report("Creating a new bootstrap stack...")
+            create_bootstrap_stack(session, postfix, report=report)
+        return get_bootstrap_stack(session, postfix)
+
+    print(f"Bootstrapping {len(seeds)} stacks in account {get_aws_account_id(session)}")
+    results = run_for_seeds(bootstrap, seeds, args.workers)
+    print_stack_table(results)
+    print(f"  AWS_REGION: {session.get_region()}")
+    print("Run polgen.py init per repo and branch to get its AWS_SECRET_ACCESS_KEY.")
+    if any(isinstance(result, Exception) for result in results.values()):
+        sys.exit(1)
 
 
 def init(args):
@@ -359,6 +764,10 @@ def init(args):
     #    7a) Add repo secrets and variables
     #    7b) Enable Workflows on forked repo
     # 8) Otherwise, print instructions for user to perform it themselves
+    if args.batch:
+        init_batch(args)
+        return
+
     repo_name = get_git_repo_name()
     if not repo_name:
         print(
@@ -375,14 +784,15 @@ def init(args):
         repo_branch = "main"
     postfix = get_postfix(f"{repo_name}/{repo_branch}")
 
-    if is_aws_interface_available():
-        aws_account_id = get_aws_account_id()
-        stack = get_bootstrap_stack(postfix)
+    session = get_aws_session()
+    if session.is_available():
+        aws_account_id = get_aws_account_id(session)
+        stack = get_bootstrap_stack(session, postfix)
         if stack:
             print("Bootstrap stack exists.")
             if request_confirmation("Update stack?"):
                 print("Updating stack...")
-                update_bootstrap_stack(postfix, stack)
+                update_bootstrap_stack(session, postfix, stack)
             else:
                 print("Skipping stack update...")
         else:
@@ -391,10 +801,10 @@ def init(args):
                 f"Create a new bootstrap stack in account {aws_account_id}?"
             ):
                 print("Creating a new bootstrap stack...")
-                create_bootstrap_stack(postfix)
+                create_bootstrap_stack(session, postfix)
 
         # Print GitHub instructions
-        stack = get_bootstrap_stack(postfix)
+        stack = get_bootstrap_stack(session, postfix)
         access_key_id = get_stack_output(stack, "AccessKeyID")
         secret_access_key = get_stack_output(stack, "SecretAccessKey")
         print("Create or update the following GitHub \033[1msecret\033[0m:")
@@ -404,7 +814,7 @@ def init(args):
         print("Create or update the following GitHub \033[1mvariables\033[0m:")
         print("")
         print(f"  AWS_ACCESS_KEY_ID: {access_key_id}")
-        print(f"  AWS_REGION: {get_aws_region()}")
+        print(f"  AWS_REGION: {session.get_region()}")
         print("")
     else:
         print(
@@ -443,14 +853,46 @@ def main():
         title="commands",
         description="Different commands that can be executed",
     )
+    seeds_parser = argparse.ArgumentParser(add_help=False)
+    seeds_parser.add_argument(
+        "--seed",
+        action="append",
+        help='Repo and branch in the format "<user/company name>/<repo name>/<branch>", can be repeated',
+    )
+    seeds_parser.add_argument(
+        "--seeds-file", help="File with one seed per line, # starts a comment"
+    )
+    seeds_parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of stacks that are handled concurrently",
+    )
+
     parser_init = subparsers.add_parser(
         "init",
         help="Initialize the GitHub and AWS accounts after having forked the repo",
+        parents=[seeds_parser],
     )
     parser_init.add_argument("--verbose", "-v", action="store_true")
+    parser_init.add_argument(
+        "--batch",
+        action="store_true",
+        help="Create or update the bootstrap stacks of the given seeds without asking",
+    )
     parser_init.set_defaults(func=init)
 
+    parser_status = subparsers.add_parser(
+        "status",
+        help="Print the state of the bootstrap stacks of the given seeds",
+        parents=[seeds_parser],
+    )
+    parser_status.add_argument("--verbose", "-v", action="store_true")
+    parser_status.set_defaults(func=status)
+
     args = parser.parse_args()
+    if args.func is init and not args.batch and (args.seed or args.seeds_file):
+        parser_init.error("--seed and --seeds-file require --batch")
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
     else:
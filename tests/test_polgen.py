@@ -0,0 +1,147 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+import subprocess
+
+import pytest
+
+import polgen
+
+POSTFIX = "0123456789abcdef"
+
+
+@pytest.fixture
+def session():
+    return polgen.FakeAWSSession()
+
+
+def test_create_bootstrap_stack(session):
+    reports = []
+    polgen.create_bootstrap_stack(session, POSTFIX, report=reports.append)
+
+    stack = polgen.get_bootstrap_stack(session, POSTFIX)
+    assert stack["StackStatus"] == "CREATE_COMPLETE"
+    assert polgen.get_stack_output(stack, "AccessKeyID")
+    resources = json.loads(polgen.CLOUDFORMATION_INIT_TEMPLATE % {"postfix": POSTFIX})[
+        "Resources"
+    ]
+    assert reports[0] == "Stack CREATE_IN_PROGRESS"
+    assert reports[-1] == "Stack CREATE_COMPLETE"
+    assert f"[{len(resources)}/{len(resources)}]" in reports[-2]
+
+
+def test_get_missing_bootstrap_stack(session):
+    assert polgen.get_bootstrap_stack(session, POSTFIX) is None
+
+
+def test_update_bootstrap_stack(session):
+    polgen.create_bootstrap_stack(session, POSTFIX, report=lambda message: None)
+    stack = polgen.get_bootstrap_stack(session, POSTFIX)
+    stack["TemplateBody"] = "{}"
+
+    reports = []
+    polgen.update_bootstrap_stack(session, POSTFIX, stack, report=reports.append)
+
+    # Only the events of the update are reported
+    assert reports == [
+        "Stack UPDATE_IN_PROGRESS",
+        "Stack UPDATE_COMPLETE_CLEANUP_IN_PROGRESS",
+        "Stack UPDATE_COMPLETE",
+    ]
+    assert polgen.get_bootstrap_stack(session, POSTFIX)["StackStatus"] == (
+        "UPDATE_COMPLETE"
+    )
+
+
+def test_update_bootstrap_stack_without_changes(session):
+    polgen.create_bootstrap_stack(session, POSTFIX, report=lambda message: None)
+    stack = polgen.get_bootstrap_stack(session, POSTFIX)
+
+    reports = []
+    polgen.update_bootstrap_stack(session, POSTFIX, stack, report=reports.append)
+
+    assert reports == ["Stack is up to date"]
+
+
+def test_wait_for_stack_failure(session):
+    polgen.create_bootstrap_stack(
+        session, POSTFIX, wait_until_created=False, report=lambda message: None
+    )
+    stack = polgen.get_bootstrap_stack(session, POSTFIX)
+    last_event_id = polgen.get_last_stack_event_id(session, stack["StackId"])
+    session.add_stack_event(stack, "UPDATE_ROLLBACK_COMPLETE")
+
+    with pytest.raises(Exception, match="UPDATE_ROLLBACK_COMPLETE"):
+        polgen.wait_for_stack(
+            session,
+            stack["StackId"],
+            "UPDATE_COMPLETE",
+            last_event_id=last_event_id,
+            report=lambda message: None,
+        )
+
+
+def test_wait_for_stack_timeout(session):
+    polgen.create_bootstrap_stack(
+        session, POSTFIX, wait_until_created=False, report=lambda message: None
+    )
+    stack = polgen.get_bootstrap_stack(session, POSTFIX)
+    last_event_id = polgen.get_last_stack_event_id(session, stack["StackId"])
+
+    with pytest.raises(Exception, match="Timed out"):
+        polgen.wait_for_stack(
+            session,
+            stack["StackId"],
+            "UPDATE_COMPLETE",
+            last_event_id=last_event_id,
+            timeout=10,
+            report=lambda message: None,
+        )
+
+
+def test_unsupported_command(session):
+    with pytest.raises(polgen.AWSCommandError) as error:
+        session.command("s3", "list_buckets", {})
+    assert error.value.code == "InvalidAction"
+
+
+def test_get_cli_error():
+    detail = "Stack with id PolGenBootstrap does not exist"
+    error = polgen.get_cli_error(
+        subprocess.CalledProcessError(
+            254,
+            ["aws"],
+            stderr=f"\nAn error occurred (ValidationError) when calling the "
+            f"DescribeStacks operation: {detail}\n",
+        )
+    )
+    assert error.code == "ValidationError"
+    assert error.detail == detail
+
+
+def test_get_cli_error_without_aws_error():
+    error = polgen.get_cli_error(
+        subprocess.CalledProcessError(
+            255, ["aws"], stderr="Unable to locate credentials"
+        )
+    )
+    assert error.code == ""
+    assert str(error) == "Unable to locate credentials"
+
+
+def test_get_client_error():
+    botocore_exceptions = pytest.importorskip("botocore.exceptions")
+    error = polgen.get_client_error(
+        botocore_exceptions.ClientError(
+            {"Error": {"Code": "ValidationError", "Message": "No updates"}},
+            "UpdateStack",
+        )
+    )
+    assert error.code == "ValidationError"
+    assert error.detail == "No updates"
+    assert str(error) == (
+        "An error occurred (ValidationError) when calling the UpdateStack operation: "
+        "No updates"
+    )